@@ -1,3 +1,6 @@
 #!/bin/bash
 
-influx -username "$INFLUXDB_ADMIN_USER" -password "$INFLUXDB_ADMIN_PASSWORD" -execute 'create database dailysummaries' -database '_internal'
\ No newline at end of file
+influx -username "$INFLUXDB_ADMIN_USER" -password "$INFLUXDB_ADMIN_PASSWORD" -execute 'create database dailysummaries' -database '_internal'
+influx -username "$INFLUXDB_ADMIN_USER" -password "$INFLUXDB_ADMIN_PASSWORD" -execute 'create database hourlysummaries' -database '_internal'
+influx -username "$INFLUXDB_ADMIN_USER" -password "$INFLUXDB_ADMIN_PASSWORD" -execute 'create database monthlysummaries' -database '_internal'
+influx -username "$INFLUXDB_ADMIN_USER" -password "$INFLUXDB_ADMIN_PASSWORD" -execute 'create database degreedays' -database '_internal'
\ No newline at end of file
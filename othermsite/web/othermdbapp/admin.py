@@ -36,6 +36,8 @@ from .models import Antifreeze
 from .models import MaintenanceHistory
 from .models import PondSpec
 from .models import ThermalLoad
+from .models import DailySummaryWatermark
+from .models import StaleDailySummary
 
 # Set basic attributes for the entire admin site
 admin.site.site_title = "oTherm Administration"
@@ -254,3 +256,5 @@ admin.site.register(EquipmentSpecMap, EquipmentSpecMapAdmin)
 admin.site.register(GhexPipeSpecifications)
 admin.site.register(Antifreeze)
 admin.site.register(MaintenanceHistory)
+admin.site.register(DailySummaryWatermark)
+admin.site.register(StaleDailySummary)
@@ -1,138 +1,756 @@
 import pandas as pd
 import numpy as np
 import datetime
-import os
+import re
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
 
-from influxdb import DataFrameClient
-from influxdb import InfluxDBClient
+from django.conf import settings
+from django.db import connections
 
-from .models import Site, Equipment
+from . import equipment_cache
+from .influx import get_client, iter_series, query_time_sliced
+from .models import Site, Equipment, DailySummaryWatermark, StaleDailySummary
  
 # queries the "dailysummary" InfluxDB for the daily summary data
-def get_daily_summaries(equip_uuid, start_date, end_date=None):
+#   the whole range is fetched with one time-range query per `chunk_days` days (instead of one
+#   query per day), and the DataFrame is built once from all of the returned points
+def get_daily_summaries(equip_uuid, start_date, end_date=None, chunk_days=366):
+    return _get_tier_summaries('dailysummaries', equip_uuid, start_date, end_date, chunk_days)
+
+
+# queries one of the summary databases ("hourlysummaries", "dailysummaries", "monthlysummaries")
+#   for the rows stamped within the days from `start_date` to `end_date`
+def _get_tier_summaries(database, equip_uuid, start_date, end_date=None, chunk_days=366):
     end_date = start_date if end_date is None else end_date
     try:
         start_dt = datetime.datetime.strptime(start_date, "%Y-%m-%d")
         end_dt = datetime.datetime.strptime(end_date, "%Y-%m-%d")
     except ValueError:
         return pd.DataFrame()
-    dfs = pd.DataFrame()
-    for day_i in range((end_dt - start_dt).days+1):
-        delta_days = datetime.timedelta(1) * day_i
-        day_n = start_dt + delta_days
-        day_string = day_n.strftime("%Y-%m-%d")
-
-        client = InfluxDBClient(host='influxdb', port=8086, username=os.environ.get('INFLUXDB_ADMIN_USER'), password=os.environ.get('INFLUXDB_ADMIN_PASSWORD'))
-        fields = f'*'
-        table = f'"dailysummaries"."autogen"."{equip_uuid}"'
-        where = f"date = '{day_string}'"
+
+    client = get_client()
+    fields = f'*'
+    table = f'"{database}"."autogen"."{equip_uuid}"'
+
+    points = []
+    chunk_start = start_dt
+    while chunk_start <= end_dt:
+        chunk_end = min(chunk_start + datetime.timedelta(days=chunk_days - 1), end_dt)
+        # summaries are stamped at the (UTC) start of the hour, day or month they summarize
+        where = (f"time >= '{chunk_start.strftime('%Y-%m-%d')}T00:00:00Z' "
+                 f"AND time < '{_next_day(chunk_end.strftime('%Y-%m-%d'))}T00:00:00Z'")
         query = (
             f"SELECT {fields} "
             f"FROM {table} "
             f"WHERE {where} ")
+        points.extend(client.query(query).get_points())
+        chunk_start = chunk_end + datetime.timedelta(days=1)
+
+    return pd.DataFrame(points)
 
-        dfs = dfs.append(pd.DataFrame(client.query(query).get_points()), ignore_index=True)
-    return dfs
 
 # queries the "otherm" InfluxDB for the equipment data
-def get_equipment_data(equipment, start_date, end_date):
-    # convert into query strings
-    start_date = "" if start_date is None else f" AND time > \'{start_date}T00:00:00.000Z\'"
-    end_date = "" if end_date is None else f" AND time < \'{end_date}T23:59:59.000Z\'"
+#   the range covers whole days:  from midnight UTC of `start_date` up to (not including)
+#   midnight UTC after `end_date`, so consecutive ranges neither overlap nor leave gaps
+#   `fields` limits the query to those fields (all fields and tags by default)
+#   when the equipment data cache is configured, days already on local disk are read from there
+#   and only the missing days are queried
+def get_equipment_data(equipment, start_date, end_date, fields=None):
+    if equipment_cache.enabled() and start_date is not None and end_date is not None:
+        return equipment_cache.get_equipment_data(equipment, start_date, end_date, fields, _query_equipment_data)
+    return _query_equipment_data(equipment, start_date, end_date, fields)
+
 
-    client = InfluxDBClient(host='influxdb', port=8086, username=os.environ.get('INFLUXDB_ADMIN_USER'), password=os.environ.get('INFLUXDB_ADMIN_PASSWORD'))
+def _query_equipment_data(equipment, start_date, end_date, fields=None):
     # Complete query of the influx database
-    fields = f'*'
+    fields = f'*' if fields is None else ", ".join(f'"{field}"' for field in fields)
+    table = f'"otherm"."autogen"."otherm-data"'
+
+    def make_query(time_conditions):
+        where = f'equipment=\'{equipment}\' {time_conditions}'
+        query = (
+            f"SELECT {fields} "
+            f"FROM {table} "
+            f"WHERE {where} ")
+        print(f"querying influxdb:\n\t{query}")
+        return query
+
+    if start_date is None or end_date is None:
+        # convert into query strings
+        start_date = "" if start_date is None else f" AND time >= \'{start_date}T00:00:00Z\'"
+        end_date = "" if end_date is None else f" AND time < \'{_next_day(end_date)}T00:00:00Z\'"
+        return series_frame(iter_series(make_query(f"{start_date} {end_date}"), epoch='ns'))
+
+    # long ranges are fetched as concurrent time slices, each streamed into its DataFrame
+    frames = query_time_sliced(lambda condition: make_query(f"AND {condition}"), start_date, end_date,
+                               fetch=lambda query, **kwargs: series_frame(iter_series(query, **kwargs)), epoch='ns')
+    frames = [frame for frame in frames if not frame.empty]
+    if not frames:
+        return pd.DataFrame()
+    return _concat_frames(frames)
+
+
+# builds a typed DataFrame straight from the columns / values of the series in an InfluxDB
+#   `ResultSet` (queried with `epoch='ns'`), without the dict-per-point stage of `get_points`:
+#   the index is the UTC `time` (datetime64), string tags and fields are categorical, and numeric
+#   fields are float32 (NaN for nulls) unless `float32` is False or they hold integers too large
+#   for float32.  sensor readings carry far fewer than float32's ~7 significant digits, and the
+#   summaries are accumulated in float64 regardless
+def result_frame(result, float32=True):
+    return series_frame(result.raw.get('series', []), float32)
+
+
+# `result_frame` of an iterable of InfluxDB series, e.g. streamed by `influx.iter_series`:  each
+#   series (or chunk of one) is typed as it comes, so its JSON values can be freed before the next
+def series_frame(series_iterable, float32=True):
+    frames = []
+    for series in series_iterable:
+        columns = list(zip(*series['values']))
+        if not columns:
+            continue
+        data = {}
+        for name, values in zip(series['columns'], columns):
+            if name != 'time':
+                data[name] = _typed_column(values, float32)
+        for tag, value in series.get('tags', {}).items():
+            data[tag] = pd.Categorical([value] * len(columns[0]))
+        index = pd.to_datetime(np.array(columns[series['columns'].index('time')], dtype=np.int64), utc=True)
+        frames.append(pd.DataFrame(data, index=index.rename('time'), columns=list(data)))
+    if not frames:
+        return pd.DataFrame()
+    return _concat_frames(frames)
+
+
+# concatenates typed frames in time order;  categorical columns whose categories differ between
+#   the frames are concatenated as objects by pandas, so they are made categorical again
+def _concat_frames(frames):
+    if len(frames) == 1:
+        return frames[0]
+    data = pd.concat(frames)
+    if not data.index.is_monotonic_increasing:
+        data = data.sort_index(kind='mergesort')
+    for name, column in frames[0].items():
+        if pd.api.types.is_categorical_dtype(column.dtype) and not pd.api.types.is_categorical_dtype(data[name].dtype):
+            data[name] = data[name].astype('category')
+    return data
+
+
+# one column of InfluxDB values (a tuple, with None for nulls) as a typed array
+def _typed_column(values, float32=True):
+    sample = next((value for value in values if value is not None), None)
+    if isinstance(sample, str):
+        return pd.Categorical(values)
+    if isinstance(sample, bool):
+        return np.array(values, dtype=object)
+    # the JSON encoding drops the fraction of whole floats, so ints and floats are not told apart
+    column = np.array(values, dtype=np.float64)
+    if not float32:
+        return column
+    large = column[np.abs(column) > FLOAT32_EXACT_INTEGER]
+    if np.any(large == np.floor(large)):
+        return column
+    return column.astype(np.float32)
+
+
+# the largest integer that float32 represents exactly (with all smaller ones)
+FLOAT32_EXACT_INTEGER = 2**24
+
+
+# queries the "otherm" InfluxDB for the daily summary columns that are plain reductions of single
+#   fields, computed by InfluxDB with `GROUP BY time(1d)` so only one row per day is transferred:
+#   OAT_F (mean), n_records, and ewt_min / ewt_max (entering water temperature while the heat pump
+#   is on).  both statements go in one request.  the other daily columns need the elapsed time
+#   between consecutive records, which InfluxQL cannot combine with the record values, and are
+#   left to `summarize_equipment_data`
+def get_daily_aggregates(equipment, start_date, end_date):
+    client = get_client()
     table = f'"otherm"."autogen"."otherm-data"'
-    where = f'equipment=\'{equipment}\' {start_date} {end_date}'
+    where = (f"equipment='{equipment}' AND time >= '{start_date}T00:00:00Z' "
+             f"AND time < '{_next_day(end_date)}T00:00:00Z'")
     query = (
-        f"SELECT {fields} "
-        f"FROM {table} "
-        f"WHERE {where} ")
-    print(f"querying influxdb:\n\t{query}")
-    
-    return pd.DataFrame(client.query(query).get_points())
+        f'SELECT mean("outdoor_temperature") AS "oat", count("outdoor_temperature") AS "n_records" '
+        f'FROM {table} '
+        f'WHERE {where} GROUP BY time(1d) fill(none); '
+        f'SELECT min("source_supplytemp") AS "ewt_min", max("source_supplytemp") AS "ewt_max" '
+        f'FROM {table} '
+        f'WHERE {where} AND "heatpump_power" > {HEATPUMP_THRESHOLD_WATTS} AND "source_supplytemp" != 0 '
+        f'GROUP BY time(1d) fill(none)')
+    oat_result, ewt_result = client.query(query)
+
+    agg = pd.DataFrame(list(oat_result.get_points()), columns=['time', 'oat', 'n_records']).set_index('time')
+    ewt = pd.DataFrame(list(ewt_result.get_points()), columns=['time', 'ewt_min', 'ewt_max']).set_index('time')
+    agg = agg.join(ewt, how='outer')
+    agg.index = pd.to_datetime(agg.index, utc=True)
+    agg['OAT_F'] = agg.pop('oat')*(9/5) + 32.
+    agg['ewt_min'] = agg['ewt_min']*(9/5)+32.
+    agg['ewt_max'] = agg['ewt_max']*(9/5)+32.
+    return agg
+
+
+# replaces the columns of `ds` that `get_daily_aggregates` computes in InfluxDB (only the EWT
+#   columns when `weather_joined`, since OAT_F and n_records then come from the joined temperatures)
+def _apply_daily_aggregates(ds, agg, weather_joined=False):
+    agg = agg.reindex(ds.index)
+    for column in ['ewt_min', 'ewt_max'] if weather_joined else ['ewt_min', 'ewt_max', 'OAT_F']:
+        ds[column] = agg[column].values
+    if not weather_joined:
+        ds['n_records'] = agg['n_records'].fillna(0).astype(np.int64).values
+    return ds
+
+
+# weather observations further apart than this are not interpolated between
+WEATHER_MAX_GAP_HOURS = 3
+# station days with fewer hours between observations (e.g. with an outage) have no station degree
+#   days, the degree days of those days are computed from the equipment's records
+STATION_DAY_MIN_HOURS = 24 - WEATHER_MAX_GAP_HOURS
+
+
+# the NWS id of the weather station of an equipment's site (None if the site has none)
+def get_weather_station(equip_uuid):
+    return Equipment.objects.filter(uuid=equip_uuid).values_list('site__weather_station_nws_id', flat=True).first()
+
+
+# the temperature_c observations of a weather station (written by the weather container as the
+#   "otherm" measurement named after the station) over the given whole-day range, plus a day on
+#   either side so the first and last records of the range can be interpolated.  with the
+#   equipment data cache configured, the observations are cached per station and day under
+#   "weather/<station>", so all of the equipment at a station share one fetch
+def get_station_weather(station, start_date, end_date):
+    start_date = (datetime.datetime.strptime(start_date, "%Y-%m-%d") - datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+    end_date = _next_day(end_date)
+    if equipment_cache.enabled():
+        return equipment_cache.get_equipment_data(f"weather/{station}", start_date, end_date, ['temperature_c'],
+                                                  _query_station_weather)
+    return _query_station_weather(f"weather/{station}", start_date, end_date)
+
+
+def _query_station_weather(key, start_date, end_date, fields=None):
+    station = key.split('/', 1)[1]
+    query = (
+        f'SELECT "temperature_c" '
+        f'FROM "otherm"."autogen"."{station}" '
+        f"WHERE time >= '{start_date}T00:00:00Z' AND time < '{_next_day(end_date)}T00:00:00Z' ")
+    return series_frame(iter_series(query, epoch='ns'), float32=False)
+
+
+# the weather temperatures (C) at the record times of `data`, linearly interpolated between the
+#   observations either side of each record;  NaN for records before the first or after the last
+#   observation, or between observations more than `WEATHER_MAX_GAP_HOURS` apart
+def align_weather(data, weather):
+    times = _record_times(data)
+    if weather.empty:
+        return np.full(len(times), np.nan)
+    weather = weather[weather['temperature_c'].notna()]
+    observed = _record_times(weather)
+    temperatures = weather['temperature_c'].values.astype(np.float64)
+    if len(observed) == 0:
+        return np.full(len(times), np.nan)
+
+    aligned = np.interp(times, observed, temperatures)
+    after = np.searchsorted(observed, times, side='left')
+    before = np.searchsorted(observed, times, side='right') - 1
+    inside = (before >= 0) & (after < len(observed))
+    gap = np.full(len(times), np.inf)
+    gap[inside] = observed[after[inside]] - observed[before[inside]]
+    aligned[gap > WEATHER_MAX_GAP_HOURS * NS_PER_HOUR] = np.nan
+    return aligned
+
+
+# the "YYYY-MM-DD" string of the day after `date_string`
+def _next_day(date_string):
+    return (datetime.datetime.strptime(date_string, "%Y-%m-%d") + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+
+
+# splits the days from `start_date` to `end_date` into consecutive (start, end) windows of
+#   `chunk_days` days, or a single window when `chunk_days` is None
+def _date_windows(start_date, end_date, chunk_days=None):
+    if chunk_days is None:
+        return [(start_date, end_date)]
+    windows = []
+    window_start = datetime.datetime.strptime(start_date, "%Y-%m-%d")
+    last_dt = datetime.datetime.strptime(end_date, "%Y-%m-%d")
+    while window_start <= last_dt:
+        window_end = min(window_start + datetime.timedelta(days=chunk_days - 1), last_dt)
+        windows.append((window_start.strftime("%Y-%m-%d"), window_end.strftime("%Y-%m-%d")))
+        window_start = window_end + datetime.timedelta(days=1)
+    return windows
+
+
+# summary columns that are not sums, so periods without records are left NaN instead of 0
+_NON_ADDITIVE_COLUMNS = ['ewt_min', 'ewt_max', 'OAT_F']
+
+# column order of the hourly, daily and monthly summaries
+SUMMARY_COLUMNS = ['runtime', 'heatpump_kwh', 'auxiliary_kwh', 'total_kwh', 'cooling_degree_days',
+                   'heating_degree_days', 'mbtus_exchanged', 'mbtus_heat', 'mbtus_cool', 'ewt_min', 'ewt_max',
+                   'OAT_F', 'n_records', 'date']
+
+# format of the `date` column for each pandas frequency
+_DATE_FORMATS = {'H': "%Y-%m-%dT%H:00", 'D': "%Y-%m-%d", 'MS': "%Y-%m"}
 
+# the fields of "otherm-data" that `summarize_equipment_data` reads
+SUMMARY_FIELDS = ['heatpump_power', 'heatpump_aux', 'source_supplytemp', 'source_returntemp', 'sourcefluid_flowrate',
+                  'heat_flow_rate', 'outdoor_temperature']
 
-# create the daily summary for the given DataFrame (typically `get_equipment_data` return value),
-#   and optionally save to InfluxDB
-def create_daily_summaries(equip_uuid, start_date, end_date, dry_run=False):
-    heatpump_threshold_watts = 500    # watts
-    data = get_equipment_data(equip_uuid, start_date, end_date)
-    data.set_index(pd.to_datetime(data['time']), inplace=True)
-    data['time_elapsed'] = data.index.to_series().diff().dt.seconds.div(3600, fill_value=0)
+HEATPUMP_THRESHOLD_WATTS = 500      # watts
+SHORT_INTERVAL_HOURS = 0.083        # longer gaps between records are not counted as runtime or energy
+DEGREE_DAY_BASE_F = 65.             # base temperature of the summaries' heating and cooling degree days
+NS_PER_HOUR = 3600 * 10**9
+NS_PER_DAY = 24 * NS_PER_HOUR
 
-    #TODO:  otherm:  move weather data to line-protocol file and upload to otherm db
-    #then join weather data with heat pump data into 'outdoor_temperature' column
 
-    data['OAT_F'] = data['outdoor_temperature']*(9/5) + 32.
+# adds rows for the periods (of `freq`) between `first` and the first row of `ds` that have no
+#   records, as `resample` does for gaps inside a single DataFrame
+def _fill_missing_periods(ds, first, freq='D'):
+    periods = pd.date_range(first, ds.index[-1], freq=freq, name=ds.index.name)
+    if len(periods) == len(ds):
+        return ds
+    ds = ds.reindex(periods)
+    additive = [c for c in ds.columns if c not in _NON_ADDITIVE_COLUMNS + ['date']]
+    ds[additive] = ds[additive].fillna(0)
+    ds['n_records'] = ds['n_records'].astype(int)
+    ds['date'] = ds.index.strftime(_DATE_FORMATS[freq])
+    return ds
+
 
-    data['cooling_degrees'] = np.where(data['OAT_F'] > 65., (data['OAT_F'] - 65) * data['time_elapsed']/24, 0.)
-    data['heating_degrees'] = np.where(data['OAT_F'] < 65., (65 - data['OAT_F']) * data['time_elapsed']/24, 0.)
+# the record times of `data` as int64 nanoseconds since the epoch (UTC), from its datetime index
+#   (`result_frame`) or from its `time` column of timestamp strings (`get_points`)
+def _record_times(data):
+    if isinstance(data.index, pd.DatetimeIndex):
+        return data.index.values.view('i8')
+    return pd.to_datetime(data['time'], utc=True).values.view('i8')
 
-    data['heatpump_on'] = np.where(data['heatpump_power'] > heatpump_threshold_watts, True, False)
 
-    data['ewt_on'] = (data['heatpump_on'] * data['source_supplytemp']).apply(lambda x: np.nan if x == 0 else x)
+# a column of `data` as a contiguous float64 array, or NaN if the column is missing
+def _float_column(data, column):
+    if column not in data.columns:
+        return np.full(len(data), np.nan)
+    return np.ascontiguousarray(data[column].values, dtype=np.float64)
 
-    data['heatpump_compressor_kwh'] = np.where(data['time_elapsed'] < 0.083,
-                                      data['heatpump_power'] * data['time_elapsed'] / 1000., 0)
 
-    if 'heatpump_aux' in data.columns:
-        data['heatpump_aux_kwh'] = np.where(data['time_elapsed'] < 0.083,
-                                     data['heatpump_aux'] * data['time_elapsed']/1000.,0)
+# reduces the records of `data` to hours:  returns the hour numbers (since the epoch) that have
+#   records, the matrix of per-hour sums (see `_summary_frame` for the columns), and the per-hour
+#   minimum and maximum entering water temperature (C) while the heat pump is on
+#   `previous_time` is the timestamp (int64 ns) of the record just before `data` (when `data` is a
+#   window of a longer range) so that the first record gets its `time_elapsed` like the others
+#   without `degree_days` the degree-day sums are left 0 (for station degree days to replace)
+def _reduce_records(data, previous_time=None, degree_days=True):
+    times = _record_times(data)
 
-    if 'sourcefluid_pump_power' in data.columns:
-        data['sourcefluid_pump_kwh'] = np.where(data['time_elapsed'] < 0.083,
-                                     data['sourcefluid_pump_power'] * data['time_elapsed']/1000.,0)
+    # hours since the previous record;  like `Series.dt.seconds`, whole days of a gap are dropped
+    elapsed_ns = np.diff(times, prepend=times[0] if previous_time is None else previous_time)
+    time_elapsed = ((elapsed_ns // 10**9) % 86400) / 3600
 
-    data['delta_t'] = np.where(data['heatpump_on'],
-                                      data['source_supplytemp'] - data['source_returntemp'], 0)
+    power = _float_column(data, 'heatpump_power')
+    supply = _float_column(data, 'source_supplytemp')
+    oat_f = _float_column(data, 'outdoor_temperature')*(9/5) + 32.
 
-    data['heatpump_runtime'] = np.where((data['time_elapsed'] < 0.083) & (data['heatpump_on']),
-                                        data['heatpump_on']*data['time_elapsed'], 0)
+    with np.errstate(invalid='ignore'):
+        heatpump_on = power > HEATPUMP_THRESHOLD_WATTS
+        counted = heatpump_on & (time_elapsed < SHORT_INTERVAL_HOURS)
+        ewt_on = np.where(heatpump_on & (supply != 0), supply, np.nan)
+
+    if degree_days:
+        with np.errstate(invalid='ignore'):
+            cooling_degrees = np.where(oat_f > DEGREE_DAY_BASE_F, (oat_f - DEGREE_DAY_BASE_F) * time_elapsed/24, 0.)
+            heating_degrees = np.where(oat_f < DEGREE_DAY_BASE_F, (DEGREE_DAY_BASE_F - oat_f) * time_elapsed/24, 0.)
+    else:
+        cooling_degrees = heating_degrees = np.zeros(len(data))
+
+    compressor_kwh = np.where(time_elapsed < SHORT_INTERVAL_HOURS, power * time_elapsed / 1000., 0)
+    aux_kwh = np.where(time_elapsed < SHORT_INTERVAL_HOURS, _float_column(data, 'heatpump_aux') * time_elapsed/1000., 0) \
+        if 'heatpump_aux' in data.columns else np.zeros(len(data))
+    runtime = np.where(counted, time_elapsed, 0)
 
     if 'heat_flow_rate' not in data.columns:
-        data['btus_exchanged'] = np.where((data['time_elapsed'] < 0.083) & (data['heatpump_on']),
-                                          900*data['sourcefluid_flowrate']*data['delta_t']*data['time_elapsed'], 0)
+        delta_t = np.where(heatpump_on, supply - _float_column(data, 'source_returntemp'), 0)
+        btus_exchanged = np.where(counted, 900*_float_column(data, 'sourcefluid_flowrate')*delta_t*time_elapsed, 0)
+    else:
+        btus_exchanged = np.where(counted, _float_column(data, 'heat_flow_rate')*time_elapsed, 0)
+
+    # same as the pandas pipeline this replaces:  `heatpump_on & btus_exchanged > 0` evaluates as
+    #   `(heatpump_on & btus_exchanged) > 0`, so any non-zero exchange counts as heating, and the
+    #   matching `< 0` test for cooling is never true.  kept as is so re-summarized days match the
+    #   summaries already in InfluxDB
+    btu_heating = np.where(heatpump_on & (btus_exchanged != 0) & ~np.isnan(btus_exchanged),
+                           3412.14 * compressor_kwh, 0)
+    btu_cooling = np.zeros(len(data))
+
+    # one reduction for every column:  sums skip NaN like `resample(...).sum()`
+    hour = times // NS_PER_HOUR
+    if np.any(hour[1:] < hour[:-1]):
+        order = np.argsort(times, kind='stable')
+        hour = hour[order]
     else:
-        data['btus_exchanged'] = np.where((data['time_elapsed'] < 0.083) & (data['heatpump_on']),
-                                          data['heat_flow_rate']*data['time_elapsed'], 0)
+        order = slice(None)
+    hours, starts = np.unique(hour, return_index=True)
+    additive = np.stack([runtime, compressor_kwh, aux_kwh, cooling_degrees, heating_degrees, btus_exchanged,
+                         btu_heating, btu_cooling, oat_f, ~np.isnan(oat_f)], axis=1)[order]
+    sums = np.add.reduceat(np.nan_to_num(additive), starts, axis=0)
+    ewt_min = np.fmin.reduceat(ewt_on[order], starts)
+    ewt_max = np.fmax.reduceat(ewt_on[order], starts)
+    return hours, sums, ewt_min, ewt_max
+
+
+# merges consecutive hours of `_reduce_records` output into days
+def _hours_to_days(hours, sums, ewt_min, ewt_max):
+    days, starts = np.unique(hours // 24, return_index=True)
+    return days, np.add.reduceat(sums, starts, axis=0), np.fmin.reduceat(ewt_min, starts), \
+        np.fmax.reduceat(ewt_max, starts)
+
 
-    data['btu_heating'] = np.where((data['heatpump_on'] & data['btus_exchanged'] > 0),
-                                   3412.14 * data['heatpump_compressor_kwh'], 0)
+# builds the summary DataFrame from reduced periods (hour or day numbers since the epoch);
+#   periods between the first and last one without any records are kept, as `resample` does
+def _summary_frame(periods, sums, ewt_min, ewt_max, freq):
+    period_ns = NS_PER_HOUR if freq == 'H' else NS_PER_DAY
+    index = pd.date_range(pd.Timestamp(periods[0] * period_ns, tz='UTC'), periods=periods[-1] - periods[0] + 1,
+                          freq=freq, name='time')
+    position = periods - periods[0]
+
+    def spread(values, fill=0.):
+        column = np.full(len(index), fill)
+        column[position] = values
+        return column
+
+    n_records = spread(sums[:, 9]).astype(np.int64)
+    ds = pd.DataFrame(index=index)
+    ds['runtime'] = spread(sums[:, 0])
+    ds['heatpump_kwh'] = spread(sums[:, 1])
+    ds['auxiliary_kwh'] = spread(sums[:, 2])
+    ds['total_kwh'] = ds['heatpump_kwh'] + ds['auxiliary_kwh']
+    ds['cooling_degree_days'] = spread(sums[:, 3])
+    ds['heating_degree_days'] = spread(sums[:, 4])
+    ds['mbtus_exchanged'] = spread(sums[:, 5])/1000
+    ds['mbtus_heat'] = spread(sums[:, 6])/1000
+    ds['mbtus_cool'] = spread(sums[:, 7])/1000
+    ds['ewt_min'] = spread(ewt_min, np.nan)*(9/5)+32.
+    ds['ewt_max'] = spread(ewt_max, np.nan)*(9/5)+32.
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ds['OAT_F'] = np.where(n_records > 0, spread(sums[:, 8]) / n_records, np.nan)
+    ds['n_records'] = n_records
+    ds['date'] = ds.index.strftime(_DATE_FORMATS[freq])
+    return ds
 
-    data['btu_cooling'] = np.where((data['heatpump_on'] & data['btus_exchanged'] < 0),
-                                   3412.14 * data['heatpump_compressor_kwh'], 0)
 
-    # Initialize data frame for computing and storing daily values
-    # use np.nan as placeholder, as needed to make consistent with
-    ds = pd.DataFrame()
+# create the hourly and daily summaries for the given DataFrame (typically `get_equipment_data`
+#   return value);  see `_reduce_records` for `previous_time`
+#
+#   every per-record quantity is computed once over float arrays, all hourly columns come out of
+#   one reduction over the (time ordered, so contiguous) runs of records of each hour, and the
+#   daily columns out of one reduction over those hours
+def summarize_equipment_tiers(data, previous_time=None, degree_days=True):
+    hours, sums, ewt_min, ewt_max = _reduce_records(data, previous_time, degree_days)
+    hourly = _summary_frame(hours, sums, ewt_min, ewt_max, 'H')
+    daily = _summary_frame(*_hours_to_days(hours, sums, ewt_min, ewt_max), 'D')
+    return hourly, daily
 
-    ds['runtime'] = data['heatpump_runtime'].resample('D').sum()
-    ds['heatpump_kwh'] = data['heatpump_compressor_kwh'].resample('D').sum()
-    ds['auxiliary_kwh'] = data['heatpump_aux_kwh'].resample('D').sum()
-    #ds['kwh_loop_pump'] = data['loop_pump_kwh'].resample('D').sum()
-    ds['total_kwh'] = ds['heatpump_kwh'] + ds['auxiliary_kwh'] #+ ds['kwh_loop_pump']
 
-    ds['cooling_degree_days'] = data['cooling_degrees'].resample('D').sum()
-    ds['heating_degree_days'] = data['heating_degrees'].resample('D').sum()
-    ds['mbtus_exchanged'] = data['btus_exchanged'].resample('D').sum()/1000
+# create the daily summary for the given DataFrame (typically `get_equipment_data` return value)
+def summarize_equipment_data(data, previous_time=None):
+    hours, sums, ewt_min, ewt_max = _reduce_records(data, previous_time)
+    return _summary_frame(*_hours_to_days(hours, sums, ewt_min, ewt_max), 'D')
 
-    ds['mbtus_heat'] = data['btu_heating'].resample('D').sum()/1000
-    ds['mbtus_cool'] = data['btu_cooling'].resample('D').sum()/1000
 
-    ds['ewt_min'] = data['ewt_on'].resample('D').min()*(9/5)+32.
-    ds['ewt_max'] = data['ewt_on'].resample('D').max()*(9/5)+32.
+# rolls daily summaries (as returned by `get_daily_summaries`) up into calendar months:  sums are
+#   added, the entering water temperature range is widened, and OAT_F is weighted by n_records.
+#   columns that no day has (NaN fields are not written to InfluxDB, e.g. ewt_min and ewt_max of
+#   an idle month) are NaN
+def rollup_monthly(daily):
+    daily = daily.set_index(pd.to_datetime(daily['time'], utc=True)).reindex(columns=SUMMARY_COLUMNS)
+    weighted_oat = (daily['OAT_F'] * daily['n_records']).resample('MS').sum()
 
-    ds['OAT_F'] = data['OAT_F'].resample('D').mean()
-    ds['n_records'] = data['OAT_F'].resample('D').count()
+    additive = [c for c in SUMMARY_COLUMNS if c not in _NON_ADDITIVE_COLUMNS + ['date']]
+    ms = daily[additive].resample('MS').sum()
+    ms['ewt_min'] = daily['ewt_min'].resample('MS').min()
+    ms['ewt_max'] = daily['ewt_max'].resample('MS').max()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ms['OAT_F'] = np.where(ms['n_records'] > 0, weighted_oat / ms['n_records'], np.nan)
+    ms['n_records'] = ms['n_records'].astype(np.int64)
+    ms['date'] = ms.index.strftime(_DATE_FORMATS['MS'])
+    ms.index.name = 'time'
+    return ms[SUMMARY_COLUMNS]
 
-    ds['date'] = ds.index.strftime("%Y-%m-%d")
 
+# the station degree days of every day of a date range, NaN on the days the station does not have
+#   them (the degree days of those days are computed from the equipment's records)
+def _range_degree_days(degree_days, start_date, end_date, hdd, cdd):
+    days = pd.date_range(start_date, end_date, freq='D', tz='UTC', name='time')
+    if degree_days.empty:
+        return pd.DataFrame(np.nan, index=days, columns=[hdd, cdd])
+    return degree_days.reindex(days)[[hdd, cdd]]
+
+
+# (re)creates the monthly summaries of every month that overlaps the given date range from the
+#   daily summaries in InfluxDB, and optionally saves them to the "monthlysummaries" InfluxDB
+def create_monthly_summaries(equip_uuid, start_date, end_date, dry_run=False):
+    month_start = start_date[:8] + '01'
+    end_dt = datetime.datetime.strptime(end_date, "%Y-%m-%d")
+    month_end = (pd.Timestamp(end_dt) + pd.offsets.MonthEnd(0)).strftime("%Y-%m-%d")
+    daily = get_daily_summaries(equip_uuid, month_start, month_end)
+    if daily.empty:
+        return pd.DataFrame()
+    ms = rollup_monthly(daily)
+    if not dry_run:
+        client = get_client(dataframe=True)
+        client.write_points(ms, measurement=equip_uuid, database='monthlysummaries', time_precision='h', protocol='line')
+    return ms
+
+
+# create the daily summaries of an equipment for the given date range, and optionally save them to
+#   InfluxDB along with the hourly summaries and the monthly rollups of the days written
+#   with `incremental`, only the days after the equipment's watermark (the last fully summarized
+#   day) are fetched and summarized, `start_date` is used when there is no watermark yet
+#   with `chunk_days`, the range is fetched and summarized `chunk_days` days at a time so that
+#   only one window of raw data is held in memory; the daily output is the same
+#   with `pushdown`, the columns of `get_daily_aggregates` are computed by InfluxDB and the raw
+#   query is limited to `SUMMARY_FIELDS` instead of every field and tag
+#   the site's weather station temperatures replace the equipment's own outdoor_temperature when
+#   `join_weather` is set, at the records the station has observations for
+def create_daily_summaries(equip_uuid, start_date, end_date, dry_run=False, incremental=False, chunk_days=None,
+                           pushdown=False, join_weather=True):
+    if incremental:
+        watermark = DailySummaryWatermark.objects.filter(equipment__uuid=equip_uuid).first()
+        if watermark is not None:
+            start_date = max(start_date, (watermark.last_date + datetime.timedelta(days=1)).strftime("%Y-%m-%d"))
+        if start_date > end_date:
+            return pd.DataFrame()
+
+    if not dry_run:
+        client = get_client(dataframe=True)
+
+    weather = pd.DataFrame()
+    degree_days = pd.DataFrame()
+    if join_weather:
+        station = get_weather_station(equip_uuid)
+        if station is not None:
+            weather = get_station_weather(station, start_date, end_date)
+        if not weather.empty:
+            # with the station's weather joined, the degree days are the station's
+            degree_days = get_station_degree_days(station, start_date, end_date, dry_run)
+    hdd, cdd = degree_day_fields(DEGREE_DAY_BASE_F)
+    # over the whole range, so that the days of windows without records get them too
+    station_degree_days = _range_degree_days(degree_days, start_date, end_date, hdd, cdd)
+    station_days = station_degree_days.index[station_degree_days.notna().all(axis=1)]
+
+    summaries = []
+    last_hour = None
+    previous_time = None
+    for window_start, window_end in _date_windows(start_date, end_date, chunk_days):
+        data = get_equipment_data(equip_uuid, window_start, window_end, SUMMARY_FIELDS if pushdown else None)
+        if data.empty:
+            continue
+        if not weather.empty:
+            # the equipment's own reading where the station has no observation (e.g. an outage)
+            aligned = align_weather(data, weather)
+            data['outdoor_temperature'] = np.where(np.isnan(aligned), _float_column(data, 'outdoor_temperature'),
+                                                   aligned)
+        window_days = pd.date_range(window_start, window_end, freq='D', tz='UTC')
+        hs, ds = summarize_equipment_tiers(data, previous_time,
+                                           degree_days=not window_days.isin(station_days).all())
+        previous_time = _record_times(data)[-1]
+        del data
+        if pushdown:
+            ds = _apply_daily_aggregates(ds, get_daily_aggregates(equip_uuid, window_start, window_end),
+                                         weather_joined=not weather.empty)
+        if summaries:
+            ds = _fill_missing_periods(ds, summaries[-1].index[-1] + pd.Timedelta(days=1), 'D')
+            hs = _fill_missing_periods(hs, last_hour + pd.Timedelta(hours=1), 'H')
+        last_hour = hs.index[-1]
+        if len(station_days):
+            # the station's degree days on the days it has them (with or without records), the
+            #   equipment's on the others
+            on_station_days = ds.index.isin(station_days)
+            window_degree_days = station_degree_days.reindex(ds.index[on_station_days])
+            ds.loc[on_station_days, 'cooling_degree_days'] = window_degree_days[cdd].values
+            ds.loc[on_station_days, 'heating_degree_days'] = window_degree_days[hdd].values
+            # station degree days are daily only
+            station_hours = hs.index.floor('D').isin(station_days)
+            hs.loc[station_hours, ['cooling_degree_days', 'heating_degree_days']] = np.nan
+
+        if not dry_run:
+            # upload to hourlysummaries and dailysummaries InfluxDB
+            client.write_points(hs, measurement=equip_uuid, database='hourlysummaries', time_precision='h', protocol='line')
+            client.write_points(ds, measurement=equip_uuid, database='dailysummaries', time_precision='h', protocol='line')
+        summaries.append(ds)
+
+    if not summaries:
+        return pd.DataFrame()
+    ds = pd.concat(summaries)
     if not dry_run:
-        # upload to dailysummaries InfluxDB
-        client = DataFrameClient(host='influxdb', port=8086, username=os.environ.get('INFLUXDB_ADMIN_USER'), password=os.environ.get('INFLUXDB_ADMIN_PASSWORD'))
-        client.write_points(ds, measurement=equip_uuid, database='dailysummaries', time_precision='h', protocol='line')
+        # monthly rows are rolled up from every daily row of the month, not just the ones written here
+        create_monthly_summaries(equip_uuid, ds['date'].iloc[0], ds['date'].iloc[-1])
+        if incremental:
+            update_watermark(equip_uuid, ds, end_date)
 
     return ds
 
+
+# moves the equipment's watermark up to the last fully summarized day in `ds`:  today is never
+#   complete, and neither may be the day of the latest record (its other records may still be on
+#   their way, by any path), so that day is summarized again by the next run
+def update_watermark(equip_uuid, ds, end_date):
+    if ds.empty:
+        return
+    yesterday = datetime.datetime.utcnow().date() - datetime.timedelta(days=1)
+    last_date = min(ds.index[-1].date() - datetime.timedelta(days=1), yesterday,
+                    datetime.datetime.strptime(end_date, "%Y-%m-%d").date())
+    watermark, created = DailySummaryWatermark.objects.get_or_create(
+        equipment=Equipment.objects.get(uuid=equip_uuid), defaults={'last_date': last_date})
+    if not created and last_date > watermark.last_date:
+        watermark.last_date = last_date
+        watermark.save()
+
+
+# the base temperatures (F) that station degree days are computed at, always including the base of
+#   the summaries
+def degree_day_bases():
+    return sorted(set(getattr(settings, 'DEGREE_DAY_BASE_TEMPERATURES_F', [])) | {DEGREE_DAY_BASE_F})
+
+
+# the "degreedays" fields of a base temperature, e.g. hdd_65 and cdd_65
+def degree_day_fields(base):
+    return f"hdd_{base:g}", f"cdd_{base:g}"
+
+
+# the daily heating and cooling degree days of a weather station (as `get_station_weather`
+#   returns) at each base temperature (F), indexed by UTC day.  like the per-record degree days of
+#   the summaries, each observation counts for the time since the previous one, except across
+#   gaps of more than `WEATHER_MAX_GAP_HOURS`;  covered_hours is the time counted on each day
+def compute_station_degree_days(weather, bases):
+    weather = weather[weather['temperature_c'].notna()]
+    if weather.empty:
+        return pd.DataFrame()
+    times = _record_times(weather)
+    temperature_f = weather['temperature_c'].values.astype(np.float64)*(9/5) + 32.
+    elapsed = np.diff(times, prepend=times[0])
+    elapsed_days = np.where(elapsed > WEATHER_MAX_GAP_HOURS * NS_PER_HOUR, 0, elapsed) / NS_PER_DAY
+
+    days, starts = np.unique(times // NS_PER_DAY, return_index=True)
+    columns = {}
+    for base in bases:
+        hdd, cdd = degree_day_fields(base)
+        columns[hdd] = np.add.reduceat(np.maximum(base - temperature_f, 0.) * elapsed_days, starts)
+        columns[cdd] = np.add.reduceat(np.maximum(temperature_f - base, 0.) * elapsed_days, starts)
+    columns['covered_hours'] = np.add.reduceat(elapsed_days * 24, starts)
+    return pd.DataFrame(columns, index=pd.to_datetime(days * NS_PER_DAY, utc=True).rename('time'))
+
+
+# the daily degree days of a weather station from the "degreedays" InfluxDB (measurement named
+#   after the station), indexed by UTC day.  days that are not stored yet are computed from the
+#   station's weather, and saved once they are over (unless `dry_run`), so every station-day is
+#   computed once and then shared by all of the equipment at the station.  days the observations
+#   cover less than `STATION_DAY_MIN_HOURS` of are neither returned nor saved
+def get_station_degree_days(station, start_date, end_date, dry_run=False):
+    bases = degree_day_bases()
+    fields = [field for base in bases for field in degree_day_fields(base)]
+    stored = _get_tier_summaries('degreedays', station, start_date, end_date)
+    if stored.empty:
+        stored = pd.DataFrame(columns=fields, index=pd.DatetimeIndex([], tz='UTC', name='time'))
+    else:
+        stored = stored.set_index(pd.to_datetime(stored.pop('time'), utc=True))
+        stored = stored.reindex(columns=fields)
+
+    days = pd.date_range(start_date, end_date, freq='D', tz='UTC', name='time')
+    missing = days[~days.isin(stored.dropna().index)]
+    if missing.empty:
+        return stored
+    weather = get_station_weather(station, missing[0].strftime("%Y-%m-%d"), missing[-1].strftime("%Y-%m-%d"))
+    computed = compute_station_degree_days(weather, bases)
+    if computed.empty:
+        return stored
+    computed = computed[computed.index.isin(missing) & (computed['covered_hours'] >= STATION_DAY_MIN_HOURS)]
+    complete = computed[computed.index < pd.Timestamp(datetime.datetime.utcnow().date(), tz='UTC')]
+    if not complete.empty and not dry_run:
+        client = get_client(dataframe=True)
+        client.write_points(complete, measurement=station, database='degreedays', time_precision='h', protocol='line')
+    return pd.concat([stored[~stored.index.isin(computed.index)], computed[fields]]).sort_index()
+
+
+# nanoseconds per unit of the InfluxDB write `time_precision`
+_PRECISION_NS = {'n': 1, 'u': 10**3, 'ms': 10**6, 's': 10**9, 'm': 60 * 10**9, 'h': 3600 * 10**9}
+
+# the measurement and tags of a line of line protocol:  everything up to the first unescaped space
+_LINE_KEY = re.compile(r'^((?:[^ \\]|\\.)+) ')
+_UNESCAPED_COMMA = re.compile(r'(?<!\\),')
+
+
+# the (equipment uuid, UTC day) pairs that lines of line protocol written to the "otherm" database
+#   have points for:  "otherm-data" points with an `equipment` tag and a timestamp (points without
+#   one are stamped with the time of writing, so are never late)
+def equipment_days_from_line_protocol(lines, time_precision='s'):
+    ns_per_unit = _PRECISION_NS[time_precision]
+    days = set()
+    for line in lines:
+        key = _LINE_KEY.match(line)
+        if key is None or line.startswith('#'):
+            continue
+        measurement, *tags = _UNESCAPED_COMMA.split(key.group(1))
+        if measurement != 'otherm-data':
+            continue
+        equipment = next((tag[len('equipment='):] for tag in tags if tag.startswith('equipment=')), None)
+        timestamp = line.rstrip().rsplit(' ', 1)[-1]
+        if equipment is None or not timestamp.lstrip('-').isdigit():
+            continue
+        days.add((equipment, int(timestamp) * ns_per_unit // NS_PER_DAY))
+
+    pairs = set()
+    for equipment, day in days:
+        try:
+            equipment = uuid.UUID(equipment)
+        except ValueError:
+            continue
+        pairs.add((equipment, datetime.date(1970, 1, 1) + datetime.timedelta(days=day)))
+    return pairs
+
+
+# records the already summarized days (up to the equipment's watermark) that an upload of line
+#   protocol to the "otherm" database wrote points for, to be re-summarized by
+#   `tasks.resummarize_stale_days`;  later days are picked up by the next incremental run.  the
+#   cached raw data of all of the days is dropped.  returns the number of stale days found
+def record_stale_days(lines, time_precision='s'):
+    pairs = equipment_days_from_line_protocol(lines, time_precision)
+    if not pairs:
+        return 0
+    if equipment_cache.enabled():
+        for equipment, day in pairs:
+            equipment_cache.invalidate(equipment, day.strftime("%Y-%m-%d"), day.strftime("%Y-%m-%d"))
+
+    watermarks = dict(DailySummaryWatermark.objects.filter(equipment__uuid__in={equipment for equipment, _ in pairs})
+                      .values_list('equipment__uuid', 'last_date'))
+    stale = [StaleDailySummary(equipment_uuid=equipment, date=day) for equipment, day in sorted(pairs)
+             if equipment in watermarks and day <= watermarks[equipment]]
+    # days uploaded again before they were re-summarized are already recorded
+    StaleDailySummary.objects.bulk_create(stale, ignore_conflicts=True)
+    return len(stale)
+
+
+# summarizes one equipment for the fleet run; never raises, so that one failing unit
+#   shows up in the report instead of stopping the rest of the fleet
+def _summarize_equipment(equip_uuid, start_date, end_date, options):
+    t0 = time.perf_counter()
+    try:
+        ds = create_daily_summaries(equip_uuid, start_date, end_date, **options)
+        return {'equipment': equip_uuid, 'rows': len(ds), 'seconds': time.perf_counter() - t0, 'error': None}
+    except Exception as e:
+        return {'equipment': equip_uuid, 'rows': 0, 'seconds': time.perf_counter() - t0,
+                'error': f"{type(e).__name__}: {e}"}
+
+
+# create the daily summaries for many equipment at once, one worker process per equipment
+#   (at most `max_workers` at a time, defaults to the number of cores), and return a report
+#   entry per equipment in the order given;  `options` are passed on to `create_daily_summaries`
+def create_fleet_daily_summaries(equip_uuids, start_date, end_date, max_workers=None, **options):
+    # the workers are forked from this process and must not share its database connections
+    connections.close_all()
+    reports = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [(str(equip_uuid), executor.submit(_summarize_equipment, str(equip_uuid), start_date, end_date, options))
+                   for equip_uuid in equip_uuids]
+        for equip_uuid, future in futures:
+            try:
+                reports.append(future.result())
+            except Exception as e:
+                # the worker process itself died (e.g. killed for running out of memory)
+                reports.append({'equipment': equip_uuid, 'rows': 0, 'seconds': 0., 'error': f"{type(e).__name__}: {e}"})
+    return reports
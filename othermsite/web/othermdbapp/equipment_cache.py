@@ -0,0 +1,186 @@
+import datetime
+import hashlib
+import os
+
+import pandas as pd
+import pyarrow as pa
+from pyarrow import feather
+from django.conf import settings
+
+
+# on-disk cache of raw equipment data ("otherm-data" points), so re-summarizing a range reads local
+#   files instead of re-pulling the points from InfluxDB over HTTP / JSON
+#
+#   one uncompressed Arrow IPC (feather v2) file per equipment, field list and UTC day:
+#       <EQUIPMENT_DATA_CACHE_DIR>/<equipment uuid>/<fields key>/<YYYY-MM-DD>.arrow
+#   files are memory-mapped when read.  days without points are cached as empty "<YYYY-MM-DD>.empty"
+#   markers.  only days that are EQUIPMENT_DATA_CACHE_LATENCY_DAYS over (UTC) are cached and read
+#   from the cache, since points of recent days may still be arriving;  the days of uploads are
+#   invalidated (see `daily_summaries.record_stale_days`).  the cache is disabled when
+#   EQUIPMENT_DATA_CACHE_DIR is not set
+#   weather station observations are cached the same way, with "weather/<station id>" as the key
+
+# cache files a process writes between full scans of the cache by `evict`:  in between, the size of
+#   the cache is estimated from the last scan and the process' own writes, and the cache is only
+#   scanned when that estimate goes over EQUIPMENT_DATA_CACHE_MAX_BYTES.  the periodic scans pick
+#   up what the other processes (fleet workers) wrote
+EVICT_SCAN_WRITES = 1000
+
+# the estimated size of the cache (None before this process' first scan), and the number of files
+#   this process wrote since its last scan
+_estimate = {'bytes': None, 'writes': 0}
+
+# the fraction of EQUIPMENT_DATA_CACHE_MAX_BYTES that `evict` frees the cache down to once it is over,
+#   so a full cache is not scanned again on every write
+EVICT_TARGET_FRACTION = 0.9
+
+
+# the equipment data of the given whole-day range (as `get_equipment_data`), read from the cache
+#   for cached days, and fetched for the others with `fetch(equipment, start_date, end_date, fields)`
+#   (one call per contiguous range of missing days) which must return a `result_frame` DataFrame
+def get_equipment_data(equipment, start_date, end_date, fields, fetch):
+    directory = _cache_directory(equipment, fields)
+    days = [day.strftime("%Y-%m-%d") for day in pd.date_range(start_date, end_date, freq='D')]
+    cached_before = _cache_horizon()
+
+    frames = {}
+    missing = [day for day in days if day >= cached_before or not _read_day(directory, day, frames)]
+    written_bytes = written_files = 0
+    for run_start, run_end in _contiguous_runs(missing):
+        data = fetch(equipment, run_start, run_end, fields)
+        by_day = {}
+        if not data.empty:
+            by_day = {day.strftime("%Y-%m-%d"): group for day, group in data.groupby(data.index.floor('D'))}
+        for day in pd.date_range(run_start, run_end, freq='D').strftime("%Y-%m-%d"):
+            if day in by_day:
+                frames[day] = by_day[day]
+            if day < cached_before:
+                written_bytes += _write_day(directory, day, by_day.get(day))
+                written_files += 1
+    if written_files:
+        _account_writes(written_bytes, written_files, settings.EQUIPMENT_DATA_CACHE_MAX_BYTES)
+
+    frames = [frames[day] for day in days if day in frames]
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames) if len(frames) > 1 else frames[0]
+
+
+# the first day ("YYYY-MM-DD") that is too recent to be cached
+def _cache_horizon():
+    latency = getattr(settings, 'EQUIPMENT_DATA_CACHE_LATENCY_DAYS', 0)
+    return (datetime.datetime.utcnow().date() - datetime.timedelta(days=latency)).strftime("%Y-%m-%d")
+
+
+# True if the cache is configured
+def enabled():
+    return bool(getattr(settings, 'EQUIPMENT_DATA_CACHE_DIR', None))
+
+
+# removes the cached days of an equipment from `start_date` to `end_date` (all cached days by
+#   default), for every field list, e.g. after points were uploaded for past days
+def invalidate(equipment, start_date=None, end_date=None):
+    equipment_directory = os.path.join(settings.EQUIPMENT_DATA_CACHE_DIR, str(equipment))
+    if not os.path.isdir(equipment_directory):
+        return
+    for fields_key in os.listdir(equipment_directory):
+        directory = os.path.join(equipment_directory, fields_key)
+        for name in os.listdir(directory):
+            day = name.split('.')[0]
+            if (start_date is None or day >= start_date) and (end_date is None or day <= end_date):
+                _remove(os.path.join(directory, name))
+
+
+# adds `size` bytes written in `files` files to the estimated size of the cache, and evicts when
+#   the estimate goes over `max_bytes`, when it is not known yet, or every EVICT_SCAN_WRITES files
+def _account_writes(size, files, max_bytes):
+    _estimate['writes'] += files
+    if _estimate['bytes'] is not None:
+        _estimate['bytes'] += size
+    if _estimate['bytes'] is None or _estimate['bytes'] > max_bytes or _estimate['writes'] >= EVICT_SCAN_WRITES:
+        evict(max_bytes)
+
+
+# when the cache holds more than `max_bytes`, deletes the least recently used cache files until it
+#   holds at most EVICT_TARGET_FRACTION of that
+def evict(max_bytes):
+    files = []
+    for root, _, names in os.walk(settings.EQUIPMENT_DATA_CACHE_DIR):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in files)
+    target_bytes = max_bytes * EVICT_TARGET_FRACTION if total > max_bytes else max_bytes
+    for _, size, path in sorted(files):
+        if total <= target_bytes:
+            break
+        _remove(path)
+        total -= size
+    _estimate['bytes'] = total
+    _estimate['writes'] = 0
+
+
+def _cache_directory(equipment, fields):
+    if fields is None:
+        fields_key = 'all'
+    else:
+        fields_key = hashlib.sha1(",".join(sorted(fields)).encode()).hexdigest()[:12]
+    return os.path.join(settings.EQUIPMENT_DATA_CACHE_DIR, str(equipment), fields_key)
+
+
+# adds the cached DataFrame of `day` to `frames` (nothing for an empty day); False if not cached
+def _read_day(directory, day, frames):
+    path = os.path.join(directory, f"{day}.arrow")
+    try:
+        table = feather.read_table(path, memory_map=True)
+    except (FileNotFoundError, pa.ArrowInvalid):
+        return os.path.exists(os.path.join(directory, f"{day}.empty"))
+    # reads refresh the modification time, which is what `evict` orders by
+    os.utime(path)
+    frames[day] = table.to_pandas()
+    return True
+
+
+# writes the DataFrame of `day` (None for a day without points) and returns the size of the file;
+#   files are written under a temporary name and renamed, so concurrent readers (fleet workers)
+#   never see partial files
+def _write_day(directory, day, data):
+    os.makedirs(directory, exist_ok=True)
+    if data is None:
+        path = os.path.join(directory, f"{day}.empty")
+        temporary = f"{path}.{os.getpid()}.tmp"
+        open(temporary, 'w').close()
+    else:
+        path = os.path.join(directory, f"{day}.arrow")
+        temporary = f"{path}.{os.getpid()}.tmp"
+        feather.write_feather(pa.Table.from_pandas(data), temporary, compression='uncompressed')
+    size = os.path.getsize(temporary)
+    os.replace(temporary, path)
+    return size
+
+
+# groups sorted "YYYY-MM-DD" days into (first, last) runs of consecutive days
+def _contiguous_runs(days):
+    runs = []
+    for day in days:
+        if runs and _next_day(runs[-1][1]) == day:
+            runs[-1][1] = day
+        else:
+            runs.append([day, day])
+    return [tuple(run) for run in runs]
+
+
+def _next_day(date_string):
+    return (datetime.datetime.strptime(date_string, "%Y-%m-%d") + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
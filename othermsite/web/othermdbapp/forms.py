@@ -1,10 +1,9 @@
 from django import forms
 from django.contrib.admin.widgets import FilteredSelectMultiple
 from django.forms import modelformset_factory
-from influxdb import InfluxDBClient
 import datetime
-import os
 
+from .influx import get_client, iter_points
 from .models import MonitoringSystem, MeasurementSpec, Equipment, \
     EquipmentMonitoringSystemSpec, Model, Site, EquipmentType, Manufacturer, \
     ThermalLoad, Source, SourceSpec, AirSourceSpec, StandingColumnSpec, \
@@ -281,7 +280,7 @@ class WeatherDataDisplayForm(forms.Form):
         new_end_date = end_date.strftime("%Y-%m-%d") + "T23:59:59.000Z"
 
         # Set the influxdb we are going to query
-        client = InfluxDBClient(host='influxdb', port=8086, username=os.environ.get('INFLUXDB_ADMIN_USER'), password=os.environ.get('INFLUXDB_ADMIN_PASSWORD'))
+        client = get_client()
 
         # Define the parameters used in the query and construct the query
         fields = '"temperature_c", "humidity_percent", "pressure_kpa", "time"'
@@ -307,7 +306,7 @@ class ModelUploadForm(forms.Form):
     files = forms.FileField(widget=forms.ClearableFileInput(attrs={'multiple': True}))
 
 class FileUploadForm(forms.Form):
-    client = InfluxDBClient(host='influxdb', port=8086, username=os.environ.get('INFLUXDB_ADMIN_USER'), password=os.environ.get('INFLUXDB_ADMIN_PASSWORD'))
+    client = get_client()
     db_list = client.get_list_database()
     DATABASES = []
 
@@ -322,7 +321,7 @@ class FileUploadForm(forms.Form):
 
 
 class TextUploadForm(forms.Form):
-    client = InfluxDBClient(host='influxdb', port=8086, username=os.environ.get('INFLUXDB_ADMIN_USER'), password=os.environ.get('INFLUXDB_ADMIN_PASSWORD'))
+    client = get_client()
     db_list = client.get_list_database()
     DATABASES = []
     TIME_PRECISIONS = (
@@ -345,11 +344,11 @@ class TextUploadForm(forms.Form):
 
 # Form that queries the influxdb to retrieve weather data for a specified site in the date range
 class DataDownloadForm(forms.Form):
-    client = InfluxDBClient(host='influxdb', port=8086, username=os.environ.get('INFLUXDB_ADMIN_USER'), password=os.environ.get('INFLUXDB_ADMIN_PASSWORD'))
+    client = get_client()
     db_list = client.get_list_database()
-    client.switch_database('otherm')
     # TODO: Make the measurement a dependent dropdown
-    measurement_list = client.get_list_measurements()
+    # The shared client is not switched to a database, the query names it
+    measurement_list = list(client.query('SHOW MEASUREMENTS', database='otherm').get_points())
     DATABASES = []
     MEASUREMENTS = []
 
@@ -386,9 +385,6 @@ class DataDownloadForm(forms.Form):
         new_start_date = start_date.strftime("%Y-%m-%d") + "T00:00:00.000Z"
         new_end_date = end_date.strftime("%Y-%m-%d") + "T23:59:59.000Z"
 
-        # Set the influxdb we are going to query
-        client = InfluxDBClient(host='influxdb', port=8086, username=os.environ.get('INFLUXDB_ADMIN_USER'), password=os.environ.get('INFLUXDB_ADMIN_PASSWORD'))
-
         # Define the parameters used in the query and construct the query
         fields = '*'
         table = f'"{database}"."autogen"."{measurement}"'
@@ -397,10 +393,8 @@ class DataDownloadForm(forms.Form):
                  f"FROM {table} "
                  f"WHERE {conditions}")
 
-        results = client.query(query)
-        points = results.get_points()
-
-        return points
+        # The points are streamed from InfluxDB as they are read, so a long range is never held in memory
+        return iter_points(query)
 
 
 class MonitoringSystemSpecForm(forms.Form):
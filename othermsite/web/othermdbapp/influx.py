@@ -0,0 +1,160 @@
+import datetime
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import influxdb
+from django.conf import settings
+from influxdb import DataFrameClient, InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+
+# the clients of `get_client`, by process id and client class
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+# the InfluxDB client of this process (a `DataFrameClient` with `dataframe`), configured from the
+#   INFLUXDB_* settings and shared by all of its threads.  its HTTP session keeps up to
+#   INFLUXDB_POOL_SIZE connections alive for reuse, where a client per call opens a new TCP
+#   connection every time.  forked processes (celery and fleet workers) get clients of their own
+#   rather than sharing the parent's connections.  never `switch_database` a shared client:  queries
+#   name their database, and writes pass theirs as `database=`
+def get_client(dataframe=False):
+    client_class = DataFrameClient if dataframe else InfluxDBClient
+    key = (os.getpid(), client_class)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = client_class(host=settings.INFLUXDB_HOST, port=settings.INFLUXDB_PORT,
+                                      username=settings.INFLUXDB_USER, password=settings.INFLUXDB_PASSWORD,
+                                      pool_size=settings.INFLUXDB_POOL_SIZE)
+                _clients[key] = client
+    return client
+
+
+# how long `field_keys` answers from its cache
+FIELD_KEYS_CACHE_SECONDS = 300
+
+# the field keys of `field_keys`, by database and measurement, with the time they were read
+_field_keys = {}
+
+
+# the field keys of a measurement as {field: type} (SHOW FIELD KEYS), read at most every
+#   FIELD_KEYS_CACHE_SECONDS per process since measurements rarely gain fields
+def field_keys(database, measurement):
+    cached = _field_keys.get((database, measurement))
+    if cached is None or time.monotonic() - cached[0] > FIELD_KEYS_CACHE_SECONDS:
+        result = get_client().query(f'SHOW FIELD KEYS ON "{database}" FROM "{measurement}"')
+        cached = (time.monotonic(), {point['fieldKey']: point['fieldType'] for point in result.get_points()})
+        _field_keys[(database, measurement)] = cached
+    return cached[1]
+
+
+# the whole-day range from `start_date` to `end_date` ("YYYY-MM-DD", both included) as
+#   consecutive [start, end) datetime slices of at most `slice_days` days
+def time_slices(start_date, end_date, slice_days):
+    start = datetime.datetime.strptime(start_date, "%Y-%m-%d")
+    end = datetime.datetime.strptime(end_date, "%Y-%m-%d") + datetime.timedelta(days=1)
+    slices = []
+    while start < end:
+        slices.append((start, min(start + datetime.timedelta(days=slice_days), end)))
+        start = slices[-1][1]
+    return slices
+
+
+# the InfluxQL condition selecting the time slice [start, end)
+def time_condition(start, end):
+    return f"time >= '{start.strftime('%Y-%m-%dT%H:%M:%SZ')}' AND time < '{end.strftime('%Y-%m-%dT%H:%M:%SZ')}'"
+
+
+# runs `make_query(time_condition)` over each time slice of the whole-day range from `start_date`
+#   to `end_date`, at most `max_workers` slices at a time, and returns the `ResultSet`s in time
+#   order.  one long query is one slow response decoded on one thread, while the slices are
+#   answered by InfluxDB and transferred concurrently.  each slice is read with
+#   `fetch(query, **query_kwargs)`, `InfluxDBClient.query` by default (a `ResultSet` per slice)
+def query_time_sliced(make_query, start_date, end_date, slice_days=None, max_workers=None, fetch=None,
+                      **query_kwargs):
+    slice_days = slice_days or settings.INFLUXDB_FETCH_SLICE_DAYS
+    max_workers = max_workers or settings.INFLUXDB_FETCH_WORKERS
+    slices = time_slices(start_date, end_date, slice_days)
+
+    def query(time_slice):
+        if fetch is not None:
+            return fetch(make_query(time_condition(*time_slice)), **query_kwargs)
+        return get_client().query(make_query(time_condition(*time_slice)), **query_kwargs)
+
+    if len(slices) == 1:
+        return [query(slices[0])]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(slices))) as executor:
+        return list(executor.map(query, slices))
+
+
+# bytes read at a time from streamed responses
+STREAM_READ_BYTES = 1 << 20
+
+# the influxdb-python releases that `_request_streamed` is known to work with (requirements.txt
+#   pins 5.2.3)
+STREAMED_CLIENT_RELEASES = ('5.2.', '5.3.')
+
+
+# sends a /query request of `client` with `params` as `InfluxDBClient.request` does, but with
+#   `stream=True`, so that the response can be read as it arrives.  the client's request does not
+#   stream in 5.2 (its chunked `query` reads the whole response), so this is the one place that
+#   uses the client's private attributes, and only with the releases it was checked against
+def _request_streamed(client, params):
+    if not influxdb.__version__.startswith(STREAMED_CLIENT_RELEASES):
+        raise RuntimeError(f"Streamed queries are not supported with influxdb {influxdb.__version__}, "
+                           f"check `_request_streamed` against its InfluxDBClient")
+    return client._session.request(method='GET', url=f"{client._baseurl}/query",
+                                   auth=(client._username, client._password), params=params,
+                                   headers=client._headers, proxies=client._proxies, verify=client._verify_ssl,
+                                   timeout=client._timeout, stream=True)
+
+
+# streams the result of an InfluxQL query from InfluxDB's chunked responses:  yields the series
+#   (dicts of 'name', 'columns', 'values' and, with GROUP BY, 'tags') of each chunk as it arrives,
+#   so no more than one chunk of `chunk_size` points is held in memory.  a series longer than a
+#   chunk comes in several parts, in time order.  `InfluxDBClient.query(chunked=True)` reads all
+#   of the chunks before returning, so the response is read here directly
+def iter_series(query, database=None, epoch=None, chunk_size=None):
+    params = {'q': query, 'chunked': 'true', 'chunk_size': chunk_size or settings.INFLUXDB_CHUNK_SIZE}
+    if database is not None:
+        params['db'] = database
+    if epoch is not None:
+        params['epoch'] = epoch
+    response = _request_streamed(get_client(), params)
+    try:
+        if 500 <= response.status_code < 600:
+            raise InfluxDBServerError(response.content)
+        if response.status_code != 200:
+            raise InfluxDBClientError(response.content, response.status_code)
+        # each chunk is one line of JSON, about a megabyte at the default chunk size:  `iter_lines`
+        #   re-joins the pieces of a line it has read so far for every piece, so they are read large
+        for line in response.iter_lines(chunk_size=STREAM_READ_BYTES):
+            if not line:
+                continue
+            chunk = json.loads(line)
+            if 'error' in chunk:
+                raise InfluxDBClientError(chunk['error'])
+            for result in chunk.get('results', []):
+                if 'error' in result:
+                    raise InfluxDBClientError(result['error'])
+                yield from result.get('series', [])
+    finally:
+        response.close()
+
+
+# streams the points of an InfluxQL query (as `iter_series`) as dicts of column values, like
+#   `ResultSet.get_points`, with the series' tags added to each point
+def iter_points(query, database=None, epoch=None, chunk_size=None):
+    for series in iter_series(query, database=database, epoch=epoch, chunk_size=chunk_size):
+        columns = series['columns']
+        tags = series.get('tags', {})
+        for values in series['values']:
+            point = dict(zip(columns, values))
+            point.update(tags)
+            yield point
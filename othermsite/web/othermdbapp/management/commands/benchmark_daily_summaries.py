@@ -0,0 +1,31 @@
+import datetime
+import time
+
+from django.core.management import BaseCommand
+from othermdbapp.daily_summaries import get_daily_summaries
+
+class Command(BaseCommand):
+    help = 'Time daily summary fetches from the InfluxDB instance for 30, 365 and 1825 day ranges.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('equipment_uuid', type=str, help="The UUID of the equipment of interest.")
+        parser.add_argument('end_date', type=str, help="The last day of every range, format: \"YYYY-MM-DD\"")
+        parser.add_argument('--days', type=int, nargs='+', default=[30, 365, 1825], help="The range lengths to time.")
+        parser.add_argument('--repeat', type=int, default=3, help="The number of timed runs per range (best is reported).")
+
+    def handle(self, *args, **kwargs):
+        equip = kwargs['equipment_uuid']
+        end_dt = datetime.datetime.strptime(kwargs['end_date'], "%Y-%m-%d")
+
+        # chunk_days=1 issues one query per day, the same round-trips as the old per-day loop
+        modes = [("per-day", 1), ("range", 366)]
+        print(f"{'days':>6} {'mode':>8} {'rows':>6} {'best [s]':>10}")
+        for n_days in kwargs['days']:
+            start_date = (end_dt - datetime.timedelta(days=n_days - 1)).strftime("%Y-%m-%d")
+            for mode, chunk_days in modes:
+                timings = []
+                for _ in range(kwargs['repeat']):
+                    t0 = time.perf_counter()
+                    df = get_daily_summaries(equip, start_date, kwargs['end_date'], chunk_days=chunk_days)
+                    timings.append(time.perf_counter() - t0)
+                print(f"{n_days:>6} {mode:>8} {len(df):>6} {min(timings):>10.3f}")
@@ -0,0 +1,191 @@
+import contextlib
+import datetime
+import io
+import json
+import re
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+import requests
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.db import connections
+from django.test.utils import override_settings
+
+from othermdbapp.daily_summaries import get_equipment_data, summarize_equipment_tiers
+from othermdbapp.influx import get_client, time_slices
+
+# the synthetic series all start here, so runs are comparable
+BENCHMARK_START = '2020-01-01'
+
+PERIOD_DAYS = {'day': 1, 'month': 30, 'year': 365}
+
+# the "otherm-data" columns `create_daily_summaries` reads, plus the equipment tag
+SERIES_COLUMNS = ['time', 'equipment', 'heatpump_aux', 'heatpump_power', 'outdoor_temperature', 'source_returntemp',
+                  'source_supplytemp', 'sourcefluid_flowrate']
+
+
+# 1-minute heat pump records of one unit over `days` days (about 2% of the minutes missing),
+#   reproducible from `seed`
+def synthetic_series(equip_uuid, days, seed):
+    rng = np.random.RandomState(seed)
+    times = pd.date_range(BENCHMARK_START, periods=days * 1440, freq='1min', tz='UTC')
+    times = times[rng.rand(len(times)) > 0.02]
+    n = len(times)
+    minutes = np.arange(n)
+    outdoor = 5 + 10*np.sin(2*np.pi*minutes/1440) + rng.normal(0, 1, n)
+    running = (np.sin(2*np.pi*minutes/90) > 0.2) | (outdoor < 0)
+    return {
+        'time': times.values.view('i8'),
+        'equipment': equip_uuid,
+        'heatpump_aux': np.where(running & (outdoor < -5), 5000., 0.),
+        'heatpump_power': np.where(running, rng.uniform(1500, 3000, n), rng.uniform(0, 40, n)).round(1),
+        'outdoor_temperature': outdoor.round(2),
+        'source_returntemp': (2 + rng.normal(0, 0.5, n)).round(2),
+        'source_supplytemp': (5 + rng.normal(0, 0.5, n)).round(2),
+        'sourcefluid_flowrate': np.where(running, rng.uniform(6, 9, n), 0.).round(2),
+    }
+
+
+# the InfluxDB /query response body for the records of a series in [start, end) (int64 ns),
+#   queried with `epoch='ns'` and `chunked=true` (as `get_equipment_data` does), as InfluxDB 1.8
+#   encodes it:  one JSON object per line and chunk of `chunk_size` records
+def query_response_body(series, start, end, chunk_size):
+    selected = (series['time'] >= start) & (series['time'] < end)
+    times = series['time'][selected]
+    columns = [times.tolist(), [series['equipment']] * len(times)] + \
+        [series[column][selected].tolist() for column in SERIES_COLUMNS[2:]]
+    values = [list(row) for row in zip(*columns)]
+    chunks = []
+    for first in range(0, len(values), chunk_size):
+        result = {'statement_id': 0, 'series': [
+            {'name': 'otherm-data', 'columns': SERIES_COLUMNS, 'values': values[first:first + chunk_size]}]}
+        if first + chunk_size < len(values):
+            result['partial'] = True
+        chunks.append(json.dumps({'results': [result]}))
+    if not chunks:
+        chunks.append(json.dumps({'results': [{'statement_id': 0}]}))
+    return ('\n'.join(chunks) + '\n').encode()
+
+
+# stands in for the InfluxDB HTTP API by patching `requests.Session.request`:  "otherm-data"
+#   queries are answered with the bodies prepared for their time range, other queries with no
+#   series, and writes are consumed and counted.  with `server_rows_per_second`, answering a query
+#   takes as long as InfluxDB reading its rows at that rate (concurrent queries overlap)
+class FakeInfluxDB:
+
+    def __init__(self, server_rows_per_second=None):
+        self.bodies = {}
+        self.lines_written = 0
+        self.server_rows_per_second = server_rows_per_second
+
+    # prepares the bodies of the queries of a series over the given [start, end) datetime ranges
+    def prepare(self, series, time_ranges):
+        self.bodies = {}
+        for start, end in time_ranges:
+            key = (series['equipment'], start.strftime('%Y-%m-%dT%H:%M:%SZ'), end.strftime('%Y-%m-%dT%H:%M:%SZ'))
+            rows = int(np.sum((series['time'] >= pd.Timestamp(start).value) & (series['time'] < pd.Timestamp(end).value)))
+            self.bodies[key] = (query_response_body(series, pd.Timestamp(start).value, pd.Timestamp(end).value,
+                                                    settings.INFLUXDB_CHUNK_SIZE), rows)
+
+    def request(self, session, method, url, params=None, data=None, **kwargs):
+        response = requests.Response()
+        response.url = url
+        if url.endswith('/write'):
+            self.lines_written += data.count(b'\n')
+            response.status_code = 204
+            response._content = b''
+            return response
+        query = params.get('q', '')
+        equipment = re.search(r"equipment='([^']+)'", query)
+        start, end = re.search(r"time >= '([^']+)'", query), re.search(r"time < '([^']+)'", query)
+        if '"otherm-data"' in query and equipment is not None:
+            response._content, rows = self.bodies[(equipment.group(1), start.group(1), end.group(1))]
+            if self.server_rows_per_second:
+                time.sleep(rows / self.server_rows_per_second)
+        else:
+            response._content = b'{"results": [{"statement_id": 0}]}'
+        response.status_code = 200
+        response.headers['Content-Type'] = 'application/json'
+        # the body is all there, also for `stream=True` requests
+        response._content_consumed = True
+        return response
+
+    def patch(self):
+        fake = self
+
+        def request(session, method, url, **kwargs):
+            return fake.request(session, method, url, **kwargs)
+        return mock.patch.object(requests.Session, 'request', request)
+
+
+def _peak_rss_mib():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# runs one case (in its own process, so its peak RSS is its own):  fetch, compute and write the
+#   summaries of `units` synthetic units over `days` days, one unit at a time
+#   `slice_days` is the time slicing of the fetch (one query for the whole range when 0)
+def run_case(units, days, slice_days, server_rows_per_second):
+    fake = FakeInfluxDB(server_rows_per_second)
+    end_date = (datetime.datetime.strptime(BENCHMARK_START, "%Y-%m-%d") + datetime.timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    time_ranges = time_slices(BENCHMARK_START, end_date, slice_days or days)
+    timings = {'fetch': 0., 'compute': 0., 'write': 0.}
+    rows = 0
+    # get_equipment_data prints its queries
+    with fake.patch(), contextlib.redirect_stdout(io.StringIO()), \
+            override_settings(EQUIPMENT_DATA_CACHE_DIR=None, INFLUXDB_FETCH_SLICE_DAYS=slice_days or days):
+        client = get_client(dataframe=True)
+        for unit in range(units):
+            equip_uuid = f"00000000-0000-0000-0000-{unit:012d}"
+            # serializing the response is InfluxDB's work, so it is not timed
+            fake.prepare(synthetic_series(equip_uuid, days, seed=unit), time_ranges)
+
+            t0 = time.perf_counter()
+            data = get_equipment_data(equip_uuid, BENCHMARK_START, end_date)
+            t1 = time.perf_counter()
+            hs, ds = summarize_equipment_tiers(data)
+            t2 = time.perf_counter()
+            client.write_points(hs, measurement=equip_uuid, database='hourlysummaries', time_precision='h', protocol='line')
+            client.write_points(ds, measurement=equip_uuid, database='dailysummaries', time_precision='h', protocol='line')
+            t3 = time.perf_counter()
+
+            timings['fetch'] += t1 - t0
+            timings['compute'] += t2 - t1
+            timings['write'] += t3 - t2
+            rows += len(data)
+            del data, hs, ds
+            fake.bodies = {}
+    return {'units': units, 'days': days, 'rows': rows, 'timings': timings, 'lines_written': fake.lines_written,
+            'peak_rss': _peak_rss_mib()}
+
+
+class Command(BaseCommand):
+    help = 'Benchmark fetching, summarizing and writing synthetic 1-minute heat pump data, through a fake InfluxDB.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--units', type=int, nargs='+', default=[1, 10, 100], help="The numbers of units to benchmark.")
+        parser.add_argument('--periods', nargs='+', default=['day', 'month', 'year'], choices=list(PERIOD_DAYS), help="The range lengths to benchmark.")
+        parser.add_argument('--slice-days', type=int, default=0, help="If provided, fetch in concurrent time slices of this many days (INFLUXDB_FETCH_SLICE_DAYS).")
+        parser.add_argument('--server-rows-per-second', type=float, default=None, help="If provided, the fake InfluxDB takes this long per row to answer a query.")
+
+    def handle(self, *args, **kwargs):
+        print(f"\n{'units':>5} {'period':>6} {'rows':>10} {'fetch [s]':>10} {'rows/s':>10} {'compute [s]':>11} "
+              f"{'rows/s':>10} {'write [s]':>10} {'lines':>8} {'lines/s':>10} {'peak RSS [MiB]':>15}")
+        # the cases run in fresh worker processes, which must not share this process' connections
+        connections.close_all()
+        for period in kwargs['periods']:
+            for units in kwargs['units']:
+                with ProcessPoolExecutor(max_workers=1) as executor:
+                    r = executor.submit(run_case, units, PERIOD_DAYS[period], kwargs['slice_days'],
+                                         kwargs['server_rows_per_second']).result()
+                t = r['timings']
+                print(f"{units:>5} {period:>6} {r['rows']:>10} {t['fetch']:>10.2f} {r['rows'] / t['fetch']:>10.0f} "
+                      f"{t['compute']:>11.2f} {r['rows'] / t['compute']:>10.0f} {t['write']:>10.2f} "
+                      f"{r['lines_written']:>8} {r['lines_written'] / t['write']:>10.0f} {r['peak_rss']:>15.0f}")
+        print()
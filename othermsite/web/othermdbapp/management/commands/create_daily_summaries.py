@@ -1,20 +1,60 @@
-from django.core.management import BaseCommand
-from othermdbapp.daily_summaries import get_equipment_data, create_daily_summaries
+from django.core.management import BaseCommand, CommandError
+from othermdbapp.daily_summaries import get_equipment_data, create_daily_summaries, create_fleet_daily_summaries
+from othermdbapp.models import Equipment
 
 class Command(BaseCommand):
-    help = 'Create daily summaries for an equipment and data range, and upload to the InfluxDB instance.'
+    help = 'Create daily summaries for an equipment (or a fleet of equipment) and data range, and upload to the InfluxDB instance.'
 
     def add_arguments(self, parser):
-        parser.add_argument('equipment_uuid', type=str, help="The UUID of the equipment of interest.")
+        parser.add_argument('equipment_uuid', nargs="?", default=None, type=str, help="The UUID of the equipment of interest (omit when using --all, --site or --equipment-type).")
         parser.add_argument('start_date', type=str, help="The start date of interest format: \"YYYY-MM-DD\"")
         parser.add_argument('end_date', type=str, help="The end date of interest format: \"YYYY-MM-DD\"")
         parser.add_argument('--dry-run', action="store_true", help="If provided, fetch and calculate the summaries with saving them to Influx.")
+        parser.add_argument('--incremental', action="store_true", help="If provided, only summarize the days after each equipment's last fully summarized day (start_date is used when there is none).")
+        parser.add_argument('--chunk-days', type=int, default=None, help="If provided, fetch and summarize the range this many days at a time to bound memory use.")
+        parser.add_argument('--pushdown', action="store_true", help="If provided, compute the mean/min/max/count columns in InfluxDB and only fetch the fields the other columns need.")
+        parser.add_argument('--no-weather', action="store_true", help="If provided, use the equipment's own outdoor_temperature instead of the site's weather station.")
+        parser.add_argument('--all', action="store_true", help="Summarize every equipment.")
+        parser.add_argument('--site', type=str, default=None, help="Summarize every equipment at this site (id or name).")
+        parser.add_argument('--equipment-type', type=str, default=None, help="Summarize every equipment of this type (name).")
+        parser.add_argument('--workers', type=int, default=None, help="The maximum number of worker processes in fleet mode (defaults to the number of cores).")
 
     def handle(self, *args, **kwargs):
         equip = kwargs['equipment_uuid']
         start_date = kwargs['start_date']
         end_date = kwargs['end_date']
         dry_run = kwargs['dry_run']
+        incremental = kwargs['incremental']
+        chunk_days = kwargs['chunk_days']
+        pushdown = kwargs['pushdown']
+        join_weather = not kwargs['no_weather']
+        site = kwargs['site']
+        equipment_type = kwargs['equipment_type']
 
-        ds = create_daily_summaries(equip, start_date, end_date, dry_run)
-        print(f"\n{ds}\n")
\ No newline at end of file
+        fleet = kwargs['all'] or site is not None or equipment_type is not None
+        if fleet == (equip is not None):
+            raise CommandError("Provide either an equipment UUID or one of --all, --site, --equipment-type.")
+
+        if not fleet:
+            ds = create_daily_summaries(equip, start_date, end_date, dry_run, incremental, chunk_days, pushdown,
+                                        join_weather)
+            print(f"\n{ds}\n")
+            return
+
+        equipment = Equipment.objects.all()
+        if site is not None:
+            equipment = equipment.filter(site_id=site) if site.isdigit() else equipment.filter(site__name=site)
+        if equipment_type is not None:
+            equipment = equipment.filter(type__name=equipment_type)
+        equip_uuids = list(equipment.order_by('id').values_list('uuid', flat=True))
+
+        reports = create_fleet_daily_summaries(equip_uuids, start_date, end_date, kwargs['workers'], dry_run=dry_run,
+                                              incremental=incremental, chunk_days=chunk_days, pushdown=pushdown,
+                                              join_weather=join_weather)
+
+        print(f"\n{'equipment':<36} {'rows':>6} {'time [s]':>9}  status")
+        for r in reports:
+            status = "ok" if r['error'] is None else r['error']
+            print(f"{r['equipment']:<36} {r['rows']:>6} {r['seconds']:>9.1f}  {status}")
+        n_failed = sum(r['error'] is not None for r in reports)
+        print(f"\n{len(reports)} equipment, {sum(r['rows'] for r in reports)} daily rows, {n_failed} failed\n")
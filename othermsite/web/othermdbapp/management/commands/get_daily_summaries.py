@@ -8,11 +8,13 @@ class Command(BaseCommand):
         parser.add_argument('equipment_uuid', type=str, help="The UUID of the equipment of interest.")
         parser.add_argument('start_date', type=str, help="The start date of interest format: \"YYYY-MM-DD\"")
         parser.add_argument('end_date', nargs="?", default=None, type=str, help="The end date of interest format: \"YYYY-MM-DD\"")
+        parser.add_argument('--chunk-days', type=int, default=366, help="The number of days fetched per InfluxDB query.")
 
     def handle(self, *args, **kwargs):
         equip = kwargs['equipment_uuid']
         start_date = kwargs['start_date']
         end_date = kwargs['end_date']
+        chunk_days = kwargs['chunk_days']
     
-        df = get_daily_summaries(equip, start_date, end_date)
+        df = get_daily_summaries(equip, start_date, end_date, chunk_days=chunk_days)
         print(f"\n{df}\n")
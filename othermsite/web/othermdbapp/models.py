@@ -91,6 +91,37 @@ class Equipment(models.Model):
         return '%s-%s-%s' % (self.site, self.model, self.description)
 
 
+class DailySummaryWatermark(models.Model):
+    equipment = models.OneToOneField('Equipment', on_delete=models.CASCADE)
+    last_date = models.DateField(help_text='last fully summarized day in the dailysummaries database')
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'daily_summary_watermark'
+
+    def __unicode__(self):
+        return u'%s-%s' % (self.equipment, self.last_date)
+
+    def __str__(self):
+        return '%s-%s' % (self.equipment, self.last_date)
+
+
+class StaleDailySummary(models.Model):
+    equipment_uuid = models.UUIDField()
+    date = models.DateField(help_text='summarized day that data was uploaded for afterwards')
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'stale_daily_summary'
+        unique_together = ('equipment_uuid', 'date')
+
+    def __unicode__(self):
+        return u'%s-%s' % (self.equipment_uuid, self.date)
+
+    def __str__(self):
+        return '%s-%s' % (self.equipment_uuid, self.date)
+
+
 class EquipmentType(models.Model):
     name = models.CharField(unique=True, max_length=20)
     description = models.TextField(blank=True, null=True)
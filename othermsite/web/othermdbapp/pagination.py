@@ -0,0 +1,128 @@
+import base64
+import binascii
+import json
+import uuid
+from collections import OrderedDict
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from .influx import get_client, iter_series
+from .serializers import metrics_query
+
+
+# the time of the last point of an InfluxDB series
+def last_time(series):
+    return series['values'][-1][series['columns'].index('time')]
+
+
+# pages through the "otherm-data" points of the listed equipment (in uuid order), at most
+#   `page_size` points per page, so no response holds more than that many points however long the
+#   requested range.  the opaque `next` cursor holds the uuid of the equipment and the time of the
+#   point the page ended at.  an equipment whose points continue on the next page is listed again
+#   there with the rest of its points.  the page's points are kept in `metrics` (lists of InfluxDB
+#   series, by equipment uuid) for the serializer to lay out, see `EquipmentDataSerializer.get_metrics`
+#   the points of up to `equipment_per_query` equipment are read with one query grouped by
+#   equipment, rather than one query per equipment.  InfluxDB returns the series in tag (uuid)
+#   order, which is the page order, so the response is streamed and left unread once the page is full
+class TimeCursorPagination(BasePagination):
+    page_size = 10000
+    page_size_query_param = 'page_size'
+    max_page_size = 100000
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+    equipment_per_query = 100
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.metrics = {}
+        self.next_cursor = None
+        # the query parameters of the points, as the view passes them to its serializer
+        context = view.get_serializer_context()
+        start_date, end_date = context['start_date'], context['end_date']
+        resolution, aggregate = context['downsampling']
+        fields = context['fields']
+        cursor = self.decode_cursor(request)
+
+        queryset = queryset.order_by('uuid')
+        if cursor is not None:
+            queryset = queryset.filter(uuid__gte=cursor[0])
+        equipment = list(queryset)
+        uuids = [str(e.uuid) for e in equipment]
+        remaining = self.get_page_size(request)
+
+        # the equipment the cursor is in continues after the cursor's point.  a downsampled point is
+        #   the period starting at its time, so the next period starts a resolution later (a period
+        #   starting before that would only aggregate the points after the cursor)
+        first = 0
+        if cursor is not None and uuids and uuids[0] == cursor[0]:
+            if resolution is None:
+                after_cursor = f"AND time > '{cursor[1]}'"
+            else:
+                after_cursor = f"AND time >= '{cursor[1]}' + {resolution}"
+            query = metrics_query(uuids[0], start_date, end_date, after_cursor, limit=remaining,
+                                  resolution=resolution, aggregate=aggregate, fields=fields)
+            series_list = get_client().query(query).raw.get('series', [])
+            self.metrics[uuids[0]] = series_list
+            remaining -= sum(len(series['values']) for series in series_list)
+            first = 1
+            if remaining == 0:
+                self.next_cursor = (uuids[0], last_time(series_list[-1]))
+                return equipment[:1]
+
+        for group_start in range(first, len(uuids), self.equipment_per_query):
+            group = uuids[group_start:group_start + self.equipment_per_query]
+            query = metrics_query(group, start_date, end_date, limit=remaining, resolution=resolution,
+                                  aggregate=aggregate, fields=fields)
+            series_iterator = iter_series(query)
+            for series in series_iterator:
+                equip_uuid = series['tags']['equipment']
+                series['values'] = series['values'][:remaining]
+                self.metrics.setdefault(equip_uuid, []).append(series)
+                remaining -= len(series['values'])
+                if remaining == 0:
+                    series_iterator.close()
+                    self.next_cursor = (equip_uuid, last_time(series))
+                    return equipment[:uuids.index(equip_uuid) + 1]
+        return equipment
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param,
+                                   self.encode_cursor(self.next_cursor))
+
+    def encode_cursor(self, cursor):
+        return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode()
+
+    # the (equipment uuid, point time) of the request's cursor, None without one
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            equipment_uuid, time = json.loads(base64.urlsafe_b64decode(encoded.encode()).decode())
+            # both go into the query
+            equipment_uuid = str(uuid.UUID(equipment_uuid))
+            if not isinstance(time, str) or "'" in time:
+                raise ValueError
+        except (AttributeError, TypeError, ValueError, binascii.Error):
+            raise NotFound(self.invalid_cursor_message)
+        return equipment_uuid, time
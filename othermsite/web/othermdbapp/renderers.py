@@ -0,0 +1,66 @@
+import csv
+import io
+import json
+
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils import encoders
+
+
+# renderers of one row per line, which can also render an iterable of rows (time series points) as
+#   they come with `stream`, see `views.TimeSeriesStreamingMixin`.  data rendered the regular way
+#   (e.g. error responses) is one row per item of a list, or a single row
+class StreamingRenderer(BaseRenderer):
+    charset = 'utf-8'
+    # the rendered rows are yielded in pieces of about this many characters
+    buffer_size = 1 << 16
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return b''.join(self.stream(data if isinstance(data, list) else [data]))
+
+    # yields the rendered rows (dicts) as bytes
+    def stream(self, rows):
+        buffer = io.StringIO()
+        write = self.writer(buffer)
+        for row in rows:
+            write(row)
+            if buffer.tell() >= self.buffer_size:
+                yield buffer.getvalue().encode(self.charset)
+                buffer.seek(0)
+                buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue().encode(self.charset)
+
+    # the function writing a row to `buffer`
+    def writer(self, buffer):
+        raise NotImplementedError('StreamingRenderer subclasses must implement writer()')
+
+
+# newline delimited JSON:  one JSON object per row and line
+class NDJSONRenderer(StreamingRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+    def writer(self, buffer):
+        def write(row):
+            buffer.write(json.dumps(row, cls=encoders.JSONEncoder, ensure_ascii=False))
+            buffer.write('\n')
+        return write
+
+
+# CSV with a header row, with the columns of the first row:  keys of later rows that the first
+#   row does not have are left out, and missing ones are left empty
+class CSVRenderer(StreamingRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+    def writer(self, buffer):
+        writers = []
+
+        def write(row):
+            if not writers:
+                writers.append(csv.DictWriter(buffer, fieldnames=list(row), extrasaction='ignore'))
+                writers[0].writeheader()
+            writers[0].writerow(row)
+        return write
@@ -1,8 +1,11 @@
+from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Prefetch
 from rest_framework import serializers
-from influxdb import InfluxDBClient
+from influxdb.resultset import ResultSet
 from influxdb.exceptions import InfluxDBClientError
 
-import os
+import datetime
+import functools
 
 
 from .models import Equipment, WeatherStation, Site, ThermalLoad, EquipmentMonitoringSystemSpec, MonitoringSystem, \
@@ -10,6 +13,220 @@ from .models import Equipment, WeatherStation, Site, ThermalLoad, EquipmentMonit
     SourceSpec, VerticalLoopSpec, AirSourceSpec, StandingColumnSpec, OpenLoopSpec, HorizontalLoopSpec, PondSpec,\
     GhexPipeSpecifications, SourceType, Antifreeze, EquipmentSpecMap, EquipmentSpec, EquipmentType, GSHPEquipmentSpec,\
     ASHPEquipmentSpec, Model, MaintenanceHistory
+from .influx import field_keys, get_client, iter_series, query_time_sliced
+
+# the time resolutions and aggregates the time series endpoints can downsample to
+#   (`?resolution=` and `?agg=`), as InfluxQL `GROUP BY time()` durations and functions
+RESOLUTIONS = ('15m', '1h', '1d')
+AGGREGATES = ('mean', 'max', 'min')
+
+
+# the (resolution, aggregate) of the request's `?resolution=` / `?agg=` query parameters, (None,
+#   None) for raw points;  the aggregate defaults to the mean.  raises a ValidationError (400) for
+#   values outside of RESOLUTIONS / AGGREGATES
+def downsampling(query_params):
+    resolution = query_params.get('resolution')
+    aggregate = query_params.get('agg')
+    if resolution is None:
+        if aggregate is not None:
+            raise serializers.ValidationError({'agg': "Only applies with a resolution."})
+        return None, None
+    if resolution not in RESOLUTIONS:
+        raise serializers.ValidationError({'resolution': f"Must be one of {', '.join(RESOLUTIONS)}."})
+    if aggregate is None:
+        aggregate = 'mean'
+    if aggregate not in AGGREGATES:
+        raise serializers.ValidationError({'agg': f"Must be one of {', '.join(AGGREGATES)}."})
+    return resolution, aggregate
+
+
+# the fields of the request's `?fields=` query parameter (comma separated), None for all fields.
+#   raises a ValidationError (400) for fields that are not field keys of the InfluxDB `measurement`
+#   nor in `known_fields`
+def requested_fields(query_params, database, measurement, known_fields=()):
+    fields = query_params.get('fields')
+    if fields is None:
+        return None
+    fields = [field.strip() for field in fields.split(',') if field.strip()]
+    if not fields:
+        raise serializers.ValidationError({'fields': "No fields given."})
+    known_fields = set(known_fields) | set(field_keys(database, measurement))
+    # the fields are quoted in the query
+    unknown = [field for field in fields if field not in known_fields or '"' in field or '\\' in field]
+    if unknown:
+        raise serializers.ValidationError({'fields': f"Unknown fields: {', '.join(unknown)}."})
+    return fields
+
+
+# the fields of "otherm-data" that `requested_fields` accepts besides its InfluxDB field keys:  the
+#   columns of the measurement types, which may not have been written yet
+def measurement_type_columns():
+    columns = MeasurementType.objects.exclude(msp_columns=None).values_list('msp_columns', flat=True)
+    return {column for type_columns in columns for column in type_columns}
+
+
+# the query of the points of `table` with the `where` condition (InfluxQL) from `start_date` to
+#   `end_date` (both "YYYY-MM-DD" and included, open ended when None), further restricted by the
+#   InfluxQL `conditions` and at most `limit` points (per series), grouped by the `group_by` tag.
+#   `fields` limits the points to those fields (all by default).  with a `resolution`, the points
+#   are the `aggregate` of each field per period of that length, in "<aggregate>_<field>" columns
+def _time_series_query(table, where, group_by, start_date=None, end_date=None, conditions="", limit=None,
+                       resolution=None, aggregate=None, fields=None):
+    # convert into query strings
+    start_date = "" if start_date is None else f" AND time > \'{start_date}T00:00:00.000Z\'"
+    end_date = "" if end_date is None else f" AND time < \'{end_date}T23:59:59.000Z\'"
+
+    # Complete query of the influx database
+    if fields is None:
+        fields = f'*' if resolution is None else f'{aggregate}(*)'
+    elif resolution is None:
+        fields = ", ".join(f'"{field}"' for field in fields)
+    else:
+        # named as InfluxDB names the columns of `<aggregate>(*)`
+        fields = ", ".join(f'{aggregate}("{field}") AS "{aggregate}_{field}"' for field in fields)
+    where = f'{where} {start_date} {end_date} {conditions}'
+    query = (
+        f"SELECT {fields} "
+        f"FROM {table} "
+        f"WHERE {where}")
+    if resolution is not None:
+        query += f' GROUP BY time({resolution}), "{group_by}" fill(none)'
+    else:
+        query += f' GROUP BY "{group_by}"'
+    if limit is not None:
+        query += f" LIMIT {limit}"
+    return query
+
+
+# the query of the "otherm-data" points of an equipment (see `_time_series_query`).  for a list of
+#   equipment uuids, the points of all of them are queried at once (one series, and `limit`, per
+#   equipment)
+def metrics_query(equip_uuid, start_date=None, end_date=None, conditions="", limit=None, resolution=None,
+                  aggregate=None, fields=None):
+    if isinstance(equip_uuid, (list, tuple)):
+        where = f"equipment =~ /^({'|'.join(str(u) for u in equip_uuid)})$/"
+    else:
+        where = f'equipment=\'{equip_uuid}\''
+    return _time_series_query('"otherm"."autogen"."otherm-data"', where, 'equipment', start_date, end_date,
+                              conditions, limit, resolution, aggregate, fields)
+
+
+# the query of the weather observations of a station (see `_time_series_query`)
+def weather_query(station, start_date=None, end_date=None, resolution=None, aggregate=None, fields=None):
+    return _time_series_query('"otherm".."weather"', f'site=\'{station}\'', 'site', start_date, end_date,
+                              resolution=resolution, aggregate=aggregate, fields=fields)
+
+
+# the layouts of the time series in the responses (`?layout=`):  a list of points (dicts), or one
+#   list of values per column ("time", "heatpump_power", ...)
+LAYOUTS = ('points', 'columnar')
+
+
+# the layout of the request's `?layout=` query parameter, "points" by default.  raises a
+#   ValidationError (400) for layouts outside of LAYOUTS
+def requested_layout(query_params):
+    layout = query_params.get('layout', 'points')
+    if layout not in LAYOUTS:
+        raise serializers.ValidationError({'layout': f"Must be one of {', '.join(LAYOUTS)}."})
+    return layout
+
+
+# the columns of an InfluxDB series, with the columns of an aggregate query ("mean_heatpump_power",
+#   ...) named after their fields
+def _series_columns(series, aggregate=None):
+    columns = series['columns']
+    if aggregate is not None:
+        prefix = f"{aggregate}_"
+        columns = [column[len(prefix):] if column.startswith(prefix) else column for column in columns]
+    return columns
+
+
+# the series of a `ResultSet`, or an iterable of series as it is
+def _series_of(result):
+    return result.raw.get('series', []) if isinstance(result, ResultSet) else result
+
+
+# the points of an InfluxDB series as dicts, with the series' tags added, and the columns of an
+#   aggregate query named after their fields (see `_series_columns`)
+def series_points(series, aggregate=None):
+    columns = _series_columns(series, aggregate)
+    tags = series.get('tags', {})
+    for values in series['values']:
+        point = dict(zip(columns, values))
+        point.update(tags)
+        yield point
+
+
+# the points of all of the series of a `ResultSet` (or an iterable of series), see `series_points`
+def result_points(result, aggregate=None):
+    for series in _series_of(result):
+        yield from series_points(series, aggregate)
+
+
+# all of the series of a `ResultSet` (or an iterable of series) as {column: [values]}, transposed
+#   straight from the `values` rows of the series.  the tags are left out (the serialized object
+#   already says which equipment or station the series are of), and a column that only some of the
+#   series have is None in the rows of the others
+def result_columns(result, aggregate=None):
+    columns = {}
+    rows = 0
+    for series in _series_of(result):
+        values = series['values']
+        for column, column_values in zip(_series_columns(series, aggregate), zip(*values)):
+            columns.setdefault(column, [None] * rows).extend(column_values)
+        rows += len(values)
+        for column_values in columns.values():
+            if len(column_values) < rows:
+                column_values.extend([None] * (rows - len(column_values)))
+    return columns
+
+
+# the series of a `ResultSet` (or an iterable of series) in the `layout` of the response (see
+#   LAYOUTS)
+def layout_series(result, aggregate=None, layout='points'):
+    if layout == 'columnar':
+        return result_columns(result, aggregate)
+    return list(result_points(result, aggregate))
+
+
+# True for "YYYY-MM-DD" strings
+def _is_date(value):
+    try:
+        datetime.datetime.strptime(value, "%Y-%m-%d")
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
+# the serializers of the multi-table subclasses of a spec model (`SourceSpec`, `EquipmentSpec`), by
+#   the accessor of the subclass from the spec ("verticalloopspec", ...), in the order the
+#   serializers are defined.  built once, on first use, when all of the serializers are defined
+@functools.lru_cache(maxsize=None)
+def spec_serializers(base):
+    registry = {}
+    subclasses = base.__subclasses__()
+    for ser in serializers.ModelSerializer.__subclasses__():
+        model = getattr(getattr(ser, 'Meta', None), 'model', None)
+        if model in subclasses:
+            registry.setdefault(model._meta.parents[base].remote_field.get_accessor_name(), ser)
+    return registry
+
+
+# the select_related() paths of the subclasses of the specs at `path` (e.g. "source__spec"), so a
+#   page of specs is resolved to their subclasses (see `concrete_spec`) in the page's query
+def spec_subclass_paths(base, path=None):
+    return [accessor if path is None else f"{path}__{accessor}" for accessor in spec_serializers(base)]
+
+
+# the (subclass instance, serializer) of a `base` spec, (None, None) if it is none of the subclasses
+def concrete_spec(spec, base):
+    for accessor, ser in spec_serializers(base).items():
+        try:
+            return getattr(spec, accessor), ser
+        except ObjectDoesNotExist:
+            pass
+    return None, None
+
 
 class WeatherStationSerializer(serializers.ModelSerializer):
 
@@ -18,23 +235,16 @@ class WeatherStationSerializer(serializers.ModelSerializer):
     def get_weather_data(self, station):
         start_date = self.context.get("start_date") 
         end_date = self.context.get("end_date")
-        
-        # convert into query strings
-        start_date = "" if start_date is None else f" AND time > \'{start_date}T00:00:00.000Z\'"
-        end_date = "" if end_date is None else f" AND time < \'{end_date}T23:59:59.000Z\'"
-        client = InfluxDBClient(host='influxdb', port=8086, username=os.environ.get('INFLUXDB_ADMIN_USER'), password=os.environ.get('INFLUXDB_ADMIN_PASSWORD'))
-        # Complete query of the influx database
-        fields = f'*'
-        table = f'"otherm".."weather"'
-        where = f'site=\'{station}\' {start_date} {end_date}'
-        query = (
-            f"SELECT {fields} "
-            f"FROM {table} "
-            f"WHERE {where} ")
+        resolution, aggregate = self.context.get("downsampling", (None, None))
+        query = weather_query(station, start_date, end_date, resolution, aggregate, self.context.get("fields"))
+
+        # with "stream" in the context the points are left to be streamed from InfluxDB as they are rendered
+        if self.context.get("stream"):
+            return result_points(iter_series(query), aggregate)
+        client = get_client()
         # Get the result set back from the query
         result_set = client.query(query)
-        points = result_set.get_points()
-        return list(points)
+        return layout_series(result_set, aggregate, self.context.get("layout", "points"))
 
     class Meta:
         model = WeatherStation
@@ -96,13 +306,21 @@ class MonSysSpecSerializer(serializers.ModelSerializer):
         fields = ('uuid', 'measurement_spec')
 
 
+# the prefetch of the specs of the monitoring systems at `path` (from a MonitoringSystem queryset by
+#   default), with their measurement specs and what those serialize, so a list of `MonSysSerializer`
+#   systems takes a fixed number of queries however long it is
+def monitoring_system_specs_prefetch(path='monitoringsystemspec_set'):
+    return Prefetch(path, queryset=MonitoringSystemSpec.objects.select_related(
+        'measurement_spec__location', 'measurement_spec__unit', 'measurement_spec__type'))
+
+
 class MonSysSerializer(serializers.ModelSerializer):
 
     monitoring_system_specs = serializers.SerializerMethodField('get_monitoring_system_specs')
 
     def get_monitoring_system_specs(self, monitoring_system):
-        return [MonSysSpecSerializer(mss).data for mss in
-                MonitoringSystemSpec.objects.filter(monitoring_system=monitoring_system)];
+        # prefetched by the viewsets, see `monitoring_system_specs_prefetch`
+        return [MonSysSpecSerializer(mss).data for mss in monitoring_system.monitoringsystemspec_set.all()]
 
     class Meta:
         model = MonitoringSystem
@@ -145,15 +363,11 @@ class EquipmentInfoSerializer(serializers.ModelSerializer):
 
 
     def get_equipment_spec(self, equipment_spec):
-        # list of EquipmentSpec subclasses (so we only have to create it once)
-        equipment_spec_subclasses = EquipmentSpec.__subclasses__()
-        # find the right serialzer class
-        for ser in serializers.ModelSerializer.__subclasses__():
-            if hasattr(ser, 'Meta') and hasattr(ser.Meta, 'model') and ser.Meta.model in equipment_spec_subclasses:
-                qs = ser.Meta.model.objects.filter(equipmentspec_ptr=equipment_spec.id)
-                if qs.count() > 0:
-                    return ser(qs.first()).data
-        return None
+        # the subclass of the spec, selected along with it by `EquipmentModelViewSet`
+        spec, ser = concrete_spec(equipment_spec, EquipmentSpec)
+        if spec is None:
+            return None
+        return ser(spec).data
 
     class Meta:
         model = EquipmentSpec
@@ -211,14 +425,11 @@ class SourceSerializer(serializers.ModelSerializer):
         return source_type.data
 
     def get_source_spec(self, source):
-        # list of SourceSpec subclasses (so we only have to create it once)
-        source_spec_subclasses = SourceSpec.__subclasses__()
-        # find the right serialzer class
-        for ser in serializers.ModelSerializer.__subclasses__():
-            if hasattr(ser, 'Meta') and hasattr(ser.Meta, 'model') and ser.Meta.model in source_spec_subclasses:
-                qs = ser.Meta.model.objects.filter(sourcespec_ptr=source.spec)
-                if qs.count() > 0:
-                    return ser(qs.first()).data
+        # the subclass of the spec, selected along with it by `SiteSourceMapViewSet`
+        if source.spec is not None:
+            spec, ser = concrete_spec(source.spec, SourceSpec)
+            if spec is not None:
+                return ser(spec).data
         return SourceSpecSerializer(source.spec).data
 
     class Meta:
@@ -324,25 +535,33 @@ class EquipmentDataSerializer(serializers.ModelSerializer):
     def get_metrics(self, equipment):
         start_date = self.context.get("start_date")
         end_date = self.context.get("end_date")
-        # convert into query strings
-        start_date = "" if start_date is None else f" AND time > \'{start_date}T00:00:00.000Z\'"
-        end_date = "" if end_date is None else f" AND time < \'{end_date}T23:59:59.000Z\'"
-
-        client = InfluxDBClient(host='influxdb', port=8086, username=os.environ.get('INFLUXDB_ADMIN_USER'), password=os.environ.get('INFLUXDB_ADMIN_PASSWORD'))
-        # Complete query of the influx database
-        fields = f'*'
-        table = f'"otherm"."autogen"."otherm-data"'
-        where = f'equipment=\'{equipment.uuid}\' {start_date} {end_date}'
-        query = (
-            f"SELECT {fields} "
-            f"FROM {table} "
-            f"WHERE {where} ")
-        # Get the result set back from the query
-        result_set = client.query(query)
-        points = result_set.get_points()
 
-        return list(points)
+        resolution, aggregate = self.context.get("downsampling", (None, None))
+        layout = self.context.get("layout", "points")
+
+        # the series of a page are fetched by the paginator (`TimeCursorPagination`)
+        if self.context.get("metrics") is not None:
+            return layout_series(self.context["metrics"].get(str(equipment.uuid), []), aggregate, layout)
+
+        def make_query(conditions=""):
+            return metrics_query(equipment.uuid, start_date, end_date, conditions, resolution=resolution,
+                                 aggregate=aggregate, fields=self.context.get("fields"))
+
+        # with "stream" in the context the points are left to be streamed from InfluxDB as they are
+        #   rendered, in a single chunked query rather than concurrent slices
+        if self.context.get("stream"):
+            return result_points(iter_series(make_query()), aggregate)
+
+        if not (_is_date(start_date) and _is_date(end_date)):
+            client = get_client()
+            # Get the result set back from the query
+            result_set = client.query(make_query())
+            return layout_series(result_set, aggregate, layout)
 
+        # long ranges are fetched as concurrent time slices, within the bounds above
+        result_sets = query_time_sliced(lambda condition: make_query(f"AND {condition}"), start_date, end_date)
+        series = [series for result_set in result_sets for series in result_set.raw.get('series', [])]
+        return layout_series(series, aggregate, layout)
 
     class Meta:
         model = Equipment
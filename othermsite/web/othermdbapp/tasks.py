@@ -0,0 +1,65 @@
+import datetime
+
+import requests
+from celery import shared_task
+from django.conf import settings
+from django.utils import timezone
+from influxdb.exceptions import InfluxDBServerError
+
+from .daily_summaries import create_daily_summaries
+from .models import Equipment, StaleDailySummary
+
+# the errors worth retrying:  InfluxDB being down or overloaded, not bad queries (InfluxDBClientError)
+RETRY_EXCEPTIONS = (InfluxDBServerError, requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+# bounds the memory of the first (full history) run of an equipment
+NIGHTLY_CHUNK_DAYS = 31
+
+# seconds to wait after an upload before re-summarizing, so that uploads in quick succession are
+#   re-summarized together
+STALE_SUMMARY_DELAY = 60
+
+
+# nightly:  queues an incremental summary of every equipment up to yesterday (UTC)
+#   one task per equipment rather than `create_fleet_daily_summaries`:  celery's prefork workers
+#   cannot start process pools of their own, and this way the fleet is spread over all workers
+@shared_task
+def summarize_fleet(end_date=None):
+    end_date = end_date or (datetime.datetime.utcnow().date() - datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+    equip_uuids = Equipment.objects.order_by('id').values_list('uuid', flat=True)
+    for equip_uuid in equip_uuids:
+        summarize_equipment.delay(str(equip_uuid), settings.DAILY_SUMMARY_START_DATE, end_date, incremental=True,
+                                  chunk_days=NIGHTLY_CHUNK_DAYS)
+    return len(equip_uuids)
+
+
+# on-demand (re)computation of the daily summaries of one equipment and date range, retried with
+#   exponential backoff when InfluxDB cannot be reached;  returns the number of daily rows written
+#   once the range is summarized (not just the days after the watermark, as with `incremental`),
+#   its days are no longer stale, unless recorded again meanwhile
+@shared_task(autoretry_for=RETRY_EXCEPTIONS, retry_backoff=True, retry_kwargs={'max_retries': 5})
+def summarize_equipment(equip_uuid, start_date, end_date, incremental=False, chunk_days=None, pushdown=False):
+    started = timezone.now()
+    ds = create_daily_summaries(equip_uuid, start_date, end_date, incremental=incremental, chunk_days=chunk_days,
+                                pushdown=pushdown)
+    if not incremental:
+        StaleDailySummary.objects.filter(equipment_uuid=equip_uuid, date__gte=start_date, date__lte=end_date,
+                                         created__lt=started).delete()
+    return len(ds)
+
+
+# re-summarizes the days recorded as stale by uploads (`daily_summaries.record_stale_days`):  one
+#   `summarize_equipment` task per equipment and contiguous range of stale days.  the days stay
+#   recorded until their task succeeds, so days whose task failed are queued again by the next run
+@shared_task
+def resummarize_stale_days():
+    stale = StaleDailySummary.objects.order_by('equipment_uuid', 'date').values_list('equipment_uuid', 'date')
+    ranges = []
+    for equip_uuid, date in stale:
+        if ranges and ranges[-1][0] == equip_uuid and ranges[-1][2] + datetime.timedelta(days=1) == date:
+            ranges[-1][2] = date
+        else:
+            ranges.append([equip_uuid, date, date])
+    for equip_uuid, start, end in ranges:
+        summarize_equipment.delay(str(equip_uuid), start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d"))
+    return len(ranges)
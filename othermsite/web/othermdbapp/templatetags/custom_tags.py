@@ -1,27 +1,21 @@
 from django import template
-from influxdb import InfluxDBClient
-from influxdb.exceptions import InfluxDBClientError
+from ..daily_summaries import get_daily_summaries
 from ..models import Equipment, EquipmentMonitoringSystemSpec, MonitoringSystemSpec
-from datetime import datetime
-import pandas as pd
+from datetime import datetime, timedelta
 
 register = template.Library()
 
-# -- begin hack to run daily summaries --
-# TODO:  set up a command to run in cron job
-from ..daily_summaries import create_daily_summaries, get_daily_summaries
-
+# shows the daily summaries of the first equipment at a site over the past 30 days, as far as the
+#   nightly `tasks.summarize_fleet` run has summarized them (nothing is computed while rendering)
 @register.simple_tag
 def daily_summary(site):
-    qs = Equipment.objects.filter(site=site).values('uuid')
-    print(qs)
-    for i in range(len(qs)):
-         equip_uuid = qs[i]['uuid']
-         print(equip_uuid)
-         df = create_daily_summaries(equip_uuid)
-         return df.to_html()
-
-# -- end hack --
+    equip_uuid = Equipment.objects.filter(site=site).values_list('uuid', flat=True).first()
+    if equip_uuid is None:
+        return ""
+    yesterday = datetime.utcnow().date() - timedelta(days=1)
+    df = get_daily_summaries(str(equip_uuid), (yesterday - timedelta(days=29)).strftime("%Y-%m-%d"),
+                             yesterday.strftime("%Y-%m-%d"))
+    return df.to_html()
 
 # Gets the quantity of equipment at a specific site
 @register.simple_tag
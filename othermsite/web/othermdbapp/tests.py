@@ -1 +1,419 @@
-# Create your tests here.
+import datetime
+import io
+import json
+import re
+import shutil
+import tempfile
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+import requests
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase, override_settings
+from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+from rest_framework.test import APIClient
+
+from . import equipment_cache
+from .daily_summaries import align_weather, create_daily_summaries, get_station_degree_days, rollup_monthly, \
+    summarize_equipment_data
+from .influx import _request_streamed, iter_series
+from .models import Equipment, EquipmentMonitoringSystemSpec, Manufacturer, MeasurementLocation, MeasurementSpec, \
+    MeasurementType, MeasurementUnit, Model, MonitoringSystem, MonitoringSystemSpec, Site, StaleDailySummary
+from .tasks import resummarize_stale_days, summarize_equipment
+
+
+# the pandas pipeline that `summarize_equipment_data` replaced, kept as the reference for its output
+def reference_daily_summaries(data):
+    heatpump_threshold_watts = 500    # watts
+    data = data.copy()
+    data.set_index(pd.to_datetime(data['time']), inplace=True)
+    data['time_elapsed'] = data.index.to_series().diff().dt.seconds.div(3600, fill_value=0)
+
+    data['OAT_F'] = data['outdoor_temperature']*(9/5) + 32.
+
+    data['cooling_degrees'] = np.where(data['OAT_F'] > 65., (data['OAT_F'] - 65) * data['time_elapsed']/24, 0.)
+    data['heating_degrees'] = np.where(data['OAT_F'] < 65., (65 - data['OAT_F']) * data['time_elapsed']/24, 0.)
+
+    data['heatpump_on'] = np.where(data['heatpump_power'] > heatpump_threshold_watts, True, False)
+
+    data['ewt_on'] = (data['heatpump_on'] * data['source_supplytemp']).apply(lambda x: np.nan if x == 0 else x)
+
+    data['heatpump_compressor_kwh'] = np.where(data['time_elapsed'] < 0.083,
+                                      data['heatpump_power'] * data['time_elapsed'] / 1000., 0)
+
+    data['heatpump_aux_kwh'] = np.where(data['time_elapsed'] < 0.083,
+                                 data['heatpump_aux'] * data['time_elapsed']/1000.,0)
+
+    data['delta_t'] = np.where(data['heatpump_on'],
+                                      data['source_supplytemp'] - data['source_returntemp'], 0)
+
+    data['heatpump_runtime'] = np.where((data['time_elapsed'] < 0.083) & (data['heatpump_on']),
+                                        data['heatpump_on']*data['time_elapsed'], 0)
+
+    if 'heat_flow_rate' not in data.columns:
+        data['btus_exchanged'] = np.where((data['time_elapsed'] < 0.083) & (data['heatpump_on']),
+                                          900*data['sourcefluid_flowrate']*data['delta_t']*data['time_elapsed'], 0)
+    else:
+        data['btus_exchanged'] = np.where((data['time_elapsed'] < 0.083) & (data['heatpump_on']),
+                                          data['heat_flow_rate']*data['time_elapsed'], 0)
+
+    data['btu_heating'] = np.where((data['heatpump_on'] & data['btus_exchanged'] > 0),
+                                   3412.14 * data['heatpump_compressor_kwh'], 0)
+
+    data['btu_cooling'] = np.where((data['heatpump_on'] & data['btus_exchanged'] < 0),
+                                   3412.14 * data['heatpump_compressor_kwh'], 0)
+
+    ds = pd.DataFrame()
+
+    ds['runtime'] = data['heatpump_runtime'].resample('D').sum()
+    ds['heatpump_kwh'] = data['heatpump_compressor_kwh'].resample('D').sum()
+    ds['auxiliary_kwh'] = data['heatpump_aux_kwh'].resample('D').sum()
+    ds['total_kwh'] = ds['heatpump_kwh'] + ds['auxiliary_kwh']
+
+    ds['cooling_degree_days'] = data['cooling_degrees'].resample('D').sum()
+    ds['heating_degree_days'] = data['heating_degrees'].resample('D').sum()
+    ds['mbtus_exchanged'] = data['btus_exchanged'].resample('D').sum()/1000
+
+    ds['mbtus_heat'] = data['btu_heating'].resample('D').sum()/1000
+    ds['mbtus_cool'] = data['btu_cooling'].resample('D').sum()/1000
+
+    ds['ewt_min'] = data['ewt_on'].resample('D').min()*(9/5)+32.
+    ds['ewt_max'] = data['ewt_on'].resample('D').max()*(9/5)+32.
+
+    ds['OAT_F'] = data['OAT_F'].resample('D').mean()
+    ds['n_records'] = data['OAT_F'].resample('D').count()
+
+    ds['date'] = ds.index.strftime("%Y-%m-%d")
+    return ds
+
+
+# irregular 1-minute heat pump records with dropouts, missing values and a multi-day gap
+def synthetic_equipment_data(start='2020-01-01', days=10, seed=0, heat_flow_rate=False):
+    rng = np.random.RandomState(seed)
+    times = pd.date_range(start, periods=days * 1440, freq='1min', tz='UTC')
+    times = times[rng.rand(len(times)) > 0.05]
+    times = times[(times < times[0] + pd.Timedelta(days=3)) | (times >= times[0] + pd.Timedelta(days=5))]
+    times = times + pd.to_timedelta(rng.randint(0, 30, len(times)), unit='s')
+    n = len(times)
+    data = pd.DataFrame({
+        'time': times.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'equipment': 'a5521cc6-825b-450b-a487-637b002777ea',
+        'heatpump_power': np.where(rng.rand(n) > 0.5, rng.uniform(600, 3000, n), rng.uniform(0, 400, n)),
+        'heatpump_aux': np.where(rng.rand(n) > 0.9, 5000., 0.),
+        'source_supplytemp': rng.uniform(-2, 15, n),
+        'source_returntemp': rng.uniform(-4, 12, n),
+        'sourcefluid_flowrate': rng.uniform(5, 10, n),
+        'outdoor_temperature': rng.uniform(-20, 35, n),
+    })
+    if heat_flow_rate:
+        data['heat_flow_rate'] = rng.uniform(-20000, 20000, n)
+    data.loc[rng.rand(n) > 0.97, 'heatpump_power'] = np.nan
+    data.loc[rng.rand(n) > 0.97, 'outdoor_temperature'] = np.nan
+    data.loc[rng.rand(n) > 0.99, 'source_supplytemp'] = 0.
+    return data
+
+
+class SummarizeEquipmentDataTests(SimpleTestCase):
+
+    def assert_matches_reference(self, data):
+        expected = reference_daily_summaries(data)
+        result = summarize_equipment_data(data)
+        pd.testing.assert_frame_equal(result, expected[result.columns])
+
+    def test_matches_pandas_pipeline(self):
+        self.assert_matches_reference(synthetic_equipment_data())
+
+    def test_matches_pandas_pipeline_with_heat_flow_rate(self):
+        self.assert_matches_reference(synthetic_equipment_data(seed=1, heat_flow_rate=True))
+
+    def test_windows_match_single_pass(self):
+        data = synthetic_equipment_data(seed=2)
+        times = pd.to_datetime(data['time'])
+        split = times < pd.Timestamp('2020-01-07', tz='UTC')
+        first, second = data[split], data[~split]
+        previous_time = pd.Timestamp(first['time'].iloc[-1]).value
+        windows = pd.concat([summarize_equipment_data(first), summarize_equipment_data(second, previous_time)])
+        pd.testing.assert_frame_equal(windows, summarize_equipment_data(data))
+
+
+class CreateDailySummariesTests(SimpleTestCase):
+
+    def setUp(self):
+        # 2020-01-04 and 2020-01-05 have no records, the weather station observes every day hourly
+        self.records = synthetic_equipment_data(seed=3)
+        rng = np.random.RandomState(3)
+        times = pd.date_range('2019-12-31', periods=12 * 24, freq='1H', tz='UTC', name='time')
+        self.weather = pd.DataFrame({'temperature_c': rng.uniform(-10, 30, len(times))}, index=times)
+        for target, value in [('get_weather_station', 'KPWM'), ('get_station_weather', self.weather),
+                              ('_get_tier_summaries', pd.DataFrame())]:
+            patcher = mock.patch(f'othermdbapp.daily_summaries.{target}', return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch('othermdbapp.daily_summaries.get_equipment_data', side_effect=self.get_equipment_data)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_equipment_data(self, equip_uuid, start_date, end_date, fields=None):
+        times = pd.to_datetime(self.records['time'], utc=True)
+        window = (times >= pd.Timestamp(start_date, tz='UTC')) & \
+                 (times < pd.Timestamp(end_date, tz='UTC') + pd.Timedelta(days=1))
+        return self.records[window].reset_index(drop=True)
+
+    def test_windows_match_single_pass_with_station_degree_days(self):
+        single_pass = create_daily_summaries('equipment', '2020-01-01', '2020-01-10', dry_run=True)
+        idle = single_pass.loc['2020-01-04':'2020-01-05']
+        self.assertTrue((idle['n_records'] == 0).all())
+        self.assertTrue((idle['heating_degree_days'] + idle['cooling_degree_days'] > 0).all())
+        for chunk_days in [1, 3, 7]:
+            with self.subTest(chunk_days=chunk_days):
+                windows = create_daily_summaries('equipment', '2020-01-01', '2020-01-10', dry_run=True,
+                                                 chunk_days=chunk_days)
+                pd.testing.assert_frame_equal(windows, single_pass)
+
+    def test_incomplete_station_days(self):
+        # a six hour outage of the station on 2020-01-09
+        day = pd.Timestamp('2020-01-09', tz='UTC')
+        hours = (self.weather.index - day) / pd.Timedelta(hours=1)
+        self.weather.drop(self.weather.index[(hours >= 6) & (hours < 12)], inplace=True)
+
+        with mock.patch('othermdbapp.daily_summaries.get_client') as get_client:
+            degree_days = get_station_degree_days('KPWM', '2020-01-01', '2020-01-10')
+        written = get_client.return_value.write_points.call_args[0][0]
+        self.assertNotIn(day, written.index)
+        self.assertNotIn(day, degree_days.dropna().index)
+        self.assertIn(day - pd.Timedelta(days=1), written.index)
+
+        # the day's degree days are the equipment's, from its records with the station's temperatures
+        data = self.records.copy()
+        aligned = align_weather(data, self.weather)
+        data['outdoor_temperature'] = np.where(np.isnan(aligned), data['outdoor_temperature'], aligned)
+        expected = summarize_equipment_data(data).loc[day]
+        ds = create_daily_summaries('equipment', '2020-01-01', '2020-01-10', dry_run=True)
+        self.assertAlmostEqual(ds.loc[day, 'heating_degree_days'], expected['heating_degree_days'])
+        self.assertAlmostEqual(ds.loc[day, 'cooling_degree_days'], expected['cooling_degree_days'])
+
+
+class RollupMonthlyTests(SimpleTestCase):
+
+    # daily summaries as `get_daily_summaries` reads them back:  fields that are NaN on every day
+    #   were never written to InfluxDB
+    def read_back(self, ds, drop_nan_fields=True):
+        daily = ds.dropna(axis=1, how='all') if drop_nan_fields else ds.copy()
+        daily.insert(0, 'time', ds.index.strftime('%Y-%m-%dT%H:%M:%SZ'))
+        return daily.reset_index(drop=True)
+
+    def test_idle_month(self):
+        # the heat pump never runs and the outdoor sensor is out:  no ewt_min, ewt_max nor OAT_F
+        data = synthetic_equipment_data(days=10, seed=3)
+        data['heatpump_power'] = 0.
+        data['outdoor_temperature'] = np.nan
+        ds = summarize_equipment_data(data)
+        self.assertTrue(ds[['ewt_min', 'ewt_max', 'OAT_F']].isna().all().all())
+
+        ms = rollup_monthly(self.read_back(ds))
+        pd.testing.assert_frame_equal(ms, rollup_monthly(self.read_back(ds, drop_nan_fields=False)))
+        self.assertTrue(ms[['ewt_min', 'ewt_max', 'OAT_F']].isna().all().all())
+        self.assertEqual(ms['runtime'].iloc[0], 0.)
+
+
+class ResummarizeStaleDaysTests(TestCase):
+    equip_uuid = 'a5521cc6-825b-450b-a487-637b002777ea'
+
+    def setUp(self):
+        for day in ['2020-01-02', '2020-01-03', '2020-01-07']:
+            StaleDailySummary.objects.create(equipment_uuid=self.equip_uuid, date=day)
+
+    def stale_days(self):
+        return [str(day) for day in StaleDailySummary.objects.order_by('date').values_list('date', flat=True)]
+
+    @mock.patch('othermdbapp.tasks.summarize_equipment.delay')
+    def test_days_stay_stale_until_summarized(self, delay):
+        resummarize_stale_days()
+        delay.assert_has_calls([mock.call(self.equip_uuid, '2020-01-02', '2020-01-03'),
+                                mock.call(self.equip_uuid, '2020-01-07', '2020-01-07')])
+        self.assertEqual(self.stale_days(), ['2020-01-02', '2020-01-03', '2020-01-07'])
+
+        with mock.patch('othermdbapp.tasks.create_daily_summaries', side_effect=InfluxDBServerError('down')):
+            with self.assertRaises(InfluxDBServerError):
+                summarize_equipment(self.equip_uuid, '2020-01-02', '2020-01-03')
+        self.assertEqual(self.stale_days(), ['2020-01-02', '2020-01-03', '2020-01-07'])
+
+        with mock.patch('othermdbapp.tasks.create_daily_summaries', return_value=pd.DataFrame(index=range(2))):
+            summarize_equipment(self.equip_uuid, '2020-01-02', '2020-01-03')
+        self.assertEqual(self.stale_days(), ['2020-01-07'])
+
+
+class EquipmentCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        cache_settings = override_settings(EQUIPMENT_DATA_CACHE_DIR=directory, EQUIPMENT_DATA_CACHE_MAX_BYTES=2**30,
+                                           EQUIPMENT_DATA_CACHE_LATENCY_DAYS=3)
+        cache_settings.enable()
+        self.addCleanup(cache_settings.disable)
+        # the records in InfluxDB:  10 days up to yesterday
+        self.yesterday = datetime.datetime.utcnow().date() - datetime.timedelta(days=1)
+        self.start = self.yesterday - datetime.timedelta(days=9)
+        data = synthetic_equipment_data(start=str(self.start), days=10, seed=4)
+        self.records = data.drop(columns=['time', 'equipment']).set_index(
+            pd.to_datetime(data['time'], utc=True).rename('time'))
+        self.fetched = []
+
+    def fetch(self, equipment, start_date, end_date, fields):
+        self.fetched.append((start_date, end_date))
+        times = self.records.index
+        return self.records[(times >= pd.Timestamp(start_date, tz='UTC')) &
+                            (times < pd.Timestamp(end_date, tz='UTC') + pd.Timedelta(days=1))]
+
+    def get_equipment_data(self):
+        return equipment_cache.get_equipment_data('equipment', str(self.start), str(self.yesterday), None, self.fetch)
+
+    def test_late_points_of_recent_days(self):
+        # a record of yesterday arrives (other than through an upload) after yesterday was summarized
+        late = self.records.iloc[[-100]]
+        self.records = self.records.drop(late.index)
+        summarize_equipment_data(self.get_equipment_data())
+        self.records = pd.concat([self.records, late]).sort_index()
+
+        resummarized = summarize_equipment_data(self.get_equipment_data())
+        pd.testing.assert_frame_equal(resummarized, summarize_equipment_data(self.records))
+        # the older days came from the cache
+        horizon = str(self.yesterday - datetime.timedelta(days=2))
+        self.assertEqual(self.fetched, [(str(self.start), str(self.yesterday)), (horizon, str(self.yesterday))])
+
+
+class MonitoringSystemQueryCountTests(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username='tester'))
+        self.measurement_type = MeasurementType.objects.create(name='heatpump_power', msp_columns=['heatpump_power'])
+        self.location = MeasurementLocation.objects.create(name='indoor unit')
+        self.unit = MeasurementUnit.objects.create(name='W')
+
+    # adds `n` monitoring systems with two measurement specs each, each assigned to an equipment
+    def add_monitoring_systems(self, n):
+        for _ in range(n):
+            i = MonitoringSystem.objects.count()
+            system = MonitoringSystem.objects.create(name=f'system {i}')
+            for j in range(2):
+                measurement_spec = MeasurementSpec.objects.create(name=f'spec {i}-{j}', type=self.measurement_type,
+                                                                  location=self.location, unit=self.unit)
+                MonitoringSystemSpec.objects.create(monitoring_system=system, measurement_type=self.measurement_type,
+                                                    measurement_spec=measurement_spec)
+            EquipmentMonitoringSystemSpec.objects.create(monitoring_system_spec=system)
+
+    def assert_fixed_query_count(self, url, queries):
+        for n, total in ((1, 1), (9, 10)):
+            self.add_monitoring_systems(n)
+            with self.assertNumQueries(queries):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.json()), total)
+
+    def test_monitoring_system_list(self):
+        self.assert_fixed_query_count('/api/monitoring_system/', 2)
+
+    def test_equipment_monitoring_list(self):
+        self.assert_fixed_query_count('/api/equipment_monitoring/', 2)
+
+
+class DownsampledPaginationTests(TestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username='tester'))
+        model = Model.objects.create(id='HXT048', manufacturer=Manufacturer.objects.create(name='manufacturer'))
+        self.equipment = Equipment.objects.create(model=model, site=Site.objects.create(name='site', zip_code='03824'))
+        # 1-minute heatpump_power points over 5 hours
+        self.times = pd.date_range('2020-01-01', periods=5 * 60, freq='1min', tz='UTC')
+        self.power = np.arange(len(self.times), dtype=np.float64)
+
+    # the series InfluxDB answers an hourly mean query of the equipment with:  a period starts at
+    #   the whole hour and aggregates the points of the period that meet the time conditions
+    def series(self, query):
+        selected = np.ones(len(self.times), dtype=bool)
+        after = re.search(r"time > '([^']+)'", query)
+        if after is not None:
+            selected &= self.times > pd.Timestamp(after.group(1))
+        from_next = re.search(r"time >= '([^']+)' \+ 1h", query)
+        if from_next is not None:
+            selected &= self.times >= pd.Timestamp(from_next.group(1)) + pd.Timedelta(hours=1)
+        hourly = pd.Series(self.power[selected], index=self.times[selected]).resample('1h').mean().dropna()
+        values = [[time.strftime('%Y-%m-%dT%H:%M:%SZ'), value] for time, value in hourly.items()]
+        limit = re.search(r"LIMIT (\d+)", query)
+        if limit is not None:
+            values = values[:int(limit.group(1))]
+        return [{'name': 'otherm-data', 'tags': {'equipment': str(self.equipment.uuid)},
+                 'columns': ['time', 'mean_heatpump_power'], 'values': values}] if values else []
+
+    def get_pages(self, url):
+        client = mock.Mock()
+        client.query.side_effect = lambda query: mock.Mock(raw={'series': self.series(query)})
+        pages = []
+        with mock.patch('othermdbapp.pagination.get_client', return_value=client), \
+                mock.patch('othermdbapp.pagination.iter_series',
+                           side_effect=lambda query: (series for series in self.series(query))):
+            while url is not None:
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                pages.append(response.json()['results'])
+                url = response.json()['next']
+        return pages
+
+    def test_no_repeated_period_at_page_boundaries(self):
+        pages = self.get_pages('/api/equipment_data/?resolution=1h&page_size=2')
+        points = [point for page in pages for equipment in page for point in equipment['heat_pump_metrics']]
+        self.assertGreater(len(pages), 2)
+        self.assertEqual([point['time'] for point in points],
+                         [f'2020-01-01T0{hour}:00:00Z' for hour in range(5)])
+        self.assertEqual([point['heatpump_power'] for point in points],
+                         [self.power[hour * 60:(hour + 1) * 60].mean() for hour in range(5)])
+
+
+class StreamedQueryTests(SimpleTestCase):
+
+    def setUp(self):
+        self.client = InfluxDBClient(host='influxdb', port=8086, username='otherm', password='secret')
+        self.chunks = [{'results': [{'statement_id': 0, 'partial': True, 'series': [
+                           {'name': 'otherm-data', 'columns': ['time', 'heatpump_power'], 'values': [[1, 2.5]]}]}]},
+                       {'results': [{'statement_id': 0, 'series': [
+                           {'name': 'otherm-data', 'columns': ['time', 'heatpump_power'], 'values': [[2, 3.5]]}]}]}]
+        patcher = mock.patch.object(requests.Session, 'request', side_effect=self.request)
+        self.request_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('othermdbapp.influx.get_client', return_value=self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def request(self, **kwargs):
+        response = requests.Response()
+        response.status_code = 200
+        response.raw = io.BytesIO(''.join(json.dumps(chunk) + '\n' for chunk in self.chunks).encode())
+        return response
+
+    # the client attributes `_request_streamed` reads, with the installed (pinned) influxdb-python
+    def test_request_streamed(self):
+        _request_streamed(self.client, {'q': 'SELECT * FROM "otherm-data"', 'chunked': 'true'})
+        self.request_mock.assert_called_once_with(
+            method='GET', url='http://influxdb:8086/query', auth=('otherm', 'secret'),
+            params={'q': 'SELECT * FROM "otherm-data"', 'chunked': 'true'}, headers=self.client._headers,
+            proxies={}, verify=False, timeout=None, stream=True)
+
+    def test_unchecked_client_release(self):
+        with mock.patch('othermdbapp.influx.influxdb.__version__', '6.0.0'):
+            with self.assertRaises(RuntimeError):
+                _request_streamed(self.client, {'q': 'SELECT * FROM "otherm-data"'})
+
+    def test_iter_series(self):
+        series = list(iter_series('SELECT * FROM "otherm-data"', epoch='ns', chunk_size=1))
+        self.assertEqual([part['values'] for part in series], [[[1, 2.5]], [[2, 3.5]]])
+        self.assertEqual(self.request_mock.call_args[1]['params']['chunk_size'], 1)
+
+    def test_iter_series_error(self):
+        self.chunks[1] = {'results': [{'statement_id': 0, 'error': 'error parsing query'}]}
+        with self.assertRaises(InfluxDBClientError):
+            list(iter_series('SELECT * FROM "otherm-data"'))
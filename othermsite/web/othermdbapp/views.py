@@ -5,12 +5,12 @@ from django.contrib import messages
 from django.contrib.messages.views import SuccessMessageMixin
 from django.contrib.auth.mixins import PermissionRequiredMixin
 from django.contrib.auth.decorators import permission_required
-from django.http import HttpResponse
+from django.http import StreamingHttpResponse
 from django.shortcuts import render, redirect
 from django.urls import reverse_lazy
 from django.views.generic import CreateView, TemplateView, FormView, ListView, DeleteView, UpdateView
-from influxdb import InfluxDBClient
-from influxdb.exceptions import InfluxDBClientError
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+from kombu.exceptions import OperationalError
 from rest_framework.mixins import RetrieveModelMixin, UpdateModelMixin, ListModelMixin
 from rest_framework.viewsets import GenericViewSet
 from rest_framework.authentication import TokenAuthentication
@@ -18,8 +18,11 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework.authtoken.views import ObtainAuthToken
 from rest_framework.authtoken.models import Token
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 from django.forms import ModelForm
-import os
+import itertools
+import logging
+import requests
 import yaml
 
 from .forms import EquipmentRegistrationForm, MonitoringSystemForm, EquipmentMonitoringSystemSpecForm, \
@@ -33,12 +36,19 @@ from .models import MonitoringSystem, Equipment, EquipmentMonitoringSystemSpec,
 
 from .serializers import EquipmentSerializer, WeatherStationSerializer, SiteSerializer, MonSysSerializer, \
     EquipmentMonitoringSystemSerializer, SiteSourceMapSerializer, EquipmentInfoSerializer, SiteThermalLoadSerializer, \
-    EquipmentDataSerializer
+    EquipmentDataSerializer, downsampling, measurement_type_columns, requested_fields, requested_layout, \
+    monitoring_system_specs_prefetch, spec_subclass_paths
 
-from .daily_summaries import create_daily_summaries, get_daily_summaries
+from .influx import get_client
+from .pagination import TimeCursorPagination
+from .renderers import CSVRenderer, NDJSONRenderer, StreamingRenderer
+from .daily_summaries import create_daily_summaries, get_daily_summaries, record_stale_days
+from .tasks import resummarize_stale_days, STALE_SUMMARY_DELAY
 
 register = template.Library()
 
+logger = logging.getLogger(__name__)
+
 class CustomAuthToken(ObtainAuthToken):
     def post(self, request, *args, **kwargs):
         serializer = self.serializer_class(data=request.data, context={'request': request})
@@ -70,12 +80,48 @@ class EquipmentViewSet(GenericViewSet, RetrieveModelMixin, ListModelMixin):
         return Response({'equipment': queryset})
 
 
-class EquipmentDataViewSet(GenericViewSet, RetrieveModelMixin, ListModelMixin):
+# lists (and retrieves) the time series points of a viewset's objects with the streaming renderers
+#   (`?format=ndjson` / `?format=csv`, or by Accept header):  one row per point, streamed from
+#   InfluxDB's chunked responses into a StreamingHttpResponse as they are read, so the download
+#   starts right away and memory does not grow with its length.  streamed lists are not paginated.
+#   `time_series_method` names the serializer method giving the points of an object.  in JSON, the
+#   points are laid out as the `?layout=` query parameter asks (see `serializers.LAYOUTS`)
+class TimeSeriesStreamingMixin:
+    renderer_classes = list(api_settings.DEFAULT_RENDERER_CLASSES) + [NDJSONRenderer, CSVRenderer]
+    time_series_method = None
+
+    def list(self, request, *args, **kwargs):
+        if not isinstance(request.accepted_renderer, StreamingRenderer):
+            return super().list(request, *args, **kwargs)
+        return self.streaming_response(self.filter_queryset(self.get_queryset()).iterator())
+
+    def retrieve(self, request, *args, **kwargs):
+        if not isinstance(request.accepted_renderer, StreamingRenderer):
+            return super().retrieve(request, *args, **kwargs)
+        return self.streaming_response([self.get_object()])
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context["stream"] = isinstance(getattr(self.request, 'accepted_renderer', None), StreamingRenderer)
+        context["layout"] = requested_layout(self.request.query_params)
+        return context
+
+    def streaming_response(self, objects):
+        renderer = self.request.accepted_renderer
+        points = getattr(self.get_serializer(), self.time_series_method)
+        rows = (point for obj in objects for point in points(obj))
+        return StreamingHttpResponse(renderer.stream(rows),
+                                     content_type=f"{renderer.media_type}; charset={renderer.charset}")
+
+
+class EquipmentDataViewSet(TimeSeriesStreamingMixin, GenericViewSet, RetrieveModelMixin, ListModelMixin):
     authentication_classes = [TokenAuthentication]
     permission_classes = [IsAuthenticated]
     serializer_class = EquipmentDataSerializer
     queryset = Equipment.objects.all()
     filterset_fields = ('site',)
+    pagination_class = TimeCursorPagination
+    time_series_method = 'get_metrics'
 
     def get(self, request):
         queryset = Equipment.objects.first()
@@ -85,13 +131,23 @@ class EquipmentDataViewSet(GenericViewSet, RetrieveModelMixin, ListModelMixin):
         context = super().get_serializer_context()
         context["start_date"] = self.request.query_params.get('start_date')
         context["end_date"] = self.request.query_params.get('end_date')
+        context["downsampling"] = downsampling(self.request.query_params)
+        # the measurement types are only read to validate `?fields=`
+        known_fields = measurement_type_columns() if 'fields' in self.request.query_params else ()
+        context["fields"] = requested_fields(self.request.query_params, 'otherm', 'otherm-data', known_fields)
+        # the series of the listed page, fetched by the paginator
+        context["metrics"] = getattr(self.paginator, 'metrics', None)
         return context
 
 class SiteSourceMapViewSet(GenericViewSet, RetrieveModelMixin, ListModelMixin):
     authentication_classes = [TokenAuthentication]
     permission_classes = [IsAuthenticated]
     serializer_class = SiteSourceMapSerializer
-    queryset = SiteSourceMap.objects.all()
+    # the sources with their specs, down to the spec subclasses and what those serialize, in one query
+    queryset = SiteSourceMap.objects.select_related(
+        'source__type', 'source__spec', *spec_subclass_paths(SourceSpec, 'source__spec'),
+        'source__spec__verticalloopspec__ghex_pipe_spec', 'source__spec__verticalloopspec__antifreeze',
+        'source__spec__horizontalloopspec__ghex_pipe_spec', 'source__spec__horizontalloopspec__antifreeze')
     filterset_fields = ('site',)
 
     def get(self, request):
@@ -116,22 +172,26 @@ class EquipmentMonitoringViewSet(GenericViewSet, RetrieveModelMixin, ListModelMi
     authentication_classes = [TokenAuthentication]
     permission_classes = [IsAuthenticated]
     serializer_class = EquipmentMonitoringSystemSerializer
-    queryset = EquipmentMonitoringSystemSpec.objects.all()
+    # the monitoring systems and their specs, in a fixed number of queries
+    queryset = EquipmentMonitoringSystemSpec.objects.select_related('monitoring_system_spec').prefetch_related(
+        monitoring_system_specs_prefetch('monitoring_system_spec__monitoringsystemspec_set'))
     filterset_fields = ('equip_id', )
 
 class EquipmentModelViewSet(GenericViewSet, RetrieveModelMixin, ListModelMixin):
     authentication_classes = [TokenAuthentication]
     permission_classes = [IsAuthenticated]
     serializer_class = EquipmentInfoSerializer
-    queryset = EquipmentSpec.objects.all()
+    # the specs with their models and subclasses, in one query
+    queryset = EquipmentSpec.objects.select_related('model__equipment_type', *spec_subclass_paths(EquipmentSpec))
     filterset_fields = ('model', )
 
-class WeatherStationViewSet(GenericViewSet, RetrieveModelMixin, ListModelMixin):
+class WeatherStationViewSet(TimeSeriesStreamingMixin, GenericViewSet, RetrieveModelMixin, ListModelMixin):
     authentication_classes = [TokenAuthentication]
     permission_classes = [IsAuthenticated]
     serializer_class = WeatherStationSerializer
     queryset = WeatherStation.objects.all()
     filterset_fields = ('nws_id',)
+    time_series_method = 'get_weather_data'
 
     def get(self, request):
         queryset = WeatherStation.objects.first()
@@ -141,6 +201,8 @@ class WeatherStationViewSet(GenericViewSet, RetrieveModelMixin, ListModelMixin):
         context = super().get_serializer_context()
         context["start_date"] = self.request.query_params.get('start_date')
         context["end_date"] = self.request.query_params.get('end_date')
+        context["downsampling"] = downsampling(self.request.query_params)
+        context["fields"] = requested_fields(self.request.query_params, 'otherm', 'weather')
         return context
 
 
@@ -148,7 +210,8 @@ class MonSysViewSet(GenericViewSet, RetrieveModelMixin, ListModelMixin):
     authentication_classes = [TokenAuthentication]
     permission_classes = [IsAuthenticated]
     serializer_class = MonSysSerializer
-    queryset = MonitoringSystem.objects.all()
+    # the monitoring systems and their specs, in a fixed number of queries
+    queryset = MonitoringSystem.objects.prefetch_related(monitoring_system_specs_prefetch())
     filterset_fields = ('id', 'name')
 
 
@@ -484,7 +547,7 @@ class AuditDataView(TemplateView):
     template_name = 'audit.html'
 
     def get_context_data(self, *args, **kwargs):
-        client = InfluxDBClient(host='influxdb', port=8086)
+        client = get_client()
         # Query the database
         results = client.query(
             'SELECT "count", "percentage" FROM "weather"."autogen"."audit" WHERE time > now() - 30d AND '
@@ -649,7 +712,7 @@ def model_upload_view(request):
     return render(request, 'model-upload.html', {'fileForm': file_form})
 
 def process_influx_protocol(request):
-    client = InfluxDBClient(host='influxdb', port=8086, username=os.environ.get('INFLUXDB_ADMIN_USER'), password=os.environ.get('INFLUXDB_ADMIN_PASSWORD'))
+    client = get_client()
     if request.method == 'POST':
         if 'fileForm' in request.POST:
             file_form = FileUploadForm(request.POST, request.FILES, prefix='file')
@@ -671,6 +734,7 @@ def process_influx_protocol(request):
                         client.write_points(all_data, database=database, time_precision=time_precision,
                                             batch_size=10000, protocol='line')
                         messages.add_message(request, messages.SUCCESS, "Points successfully written")
+                        queue_stale_summaries(database, all_data, time_precision)
                     except InfluxDBClientError as e:
                         e = str(e)
                         messages.add_message(request, messages.ERROR, e)
@@ -691,6 +755,7 @@ def process_influx_protocol(request):
                     client.write_points(all_data, database=database, time_precision=time_precision, batch_size=10000,
                                         protocol='line')
                     messages.add_message(request, messages.SUCCESS, "Points successfully written")
+                    queue_stale_summaries(database, all_data, time_precision)
                 except InfluxDBClientError as e:
                     e = str(e)
                     if len(e) > 300:
@@ -702,16 +767,32 @@ def process_influx_protocol(request):
 
     return render(request, 'data_upload.html', {'fileForm': file_form, 'textForm': text_form})
 
+# records the already summarized days that uploaded equipment data was written for, and queues
+#   their re-summarization.  when the broker cannot be reached, the recorded days are left to the
+#   hourly `resummarize_stale_days` beat rather than failing an upload that was already written
+def queue_stale_summaries(database, lines, time_precision):
+    if database != 'otherm':
+        return
+    if record_stale_days(lines, time_precision):
+        try:
+            resummarize_stale_days.apply_async(countdown=STALE_SUMMARY_DELAY)
+        except OperationalError:
+            logger.exception("Could not queue the re-summarization of the stale days of an upload")
+
 class DataDownloadFormView(FormView):
     form_class = DataDownloadForm
     template_name = 'data_download.html'
     def form_valid(self, form):
+        data = form.query_database()
         try:
-            data = form.query_database()
-            response = HttpResponse(data, content_type='text/plain')
-        except:
-            print("Error occurred while querying the database")
-        return response
+            # the query is sent (and fails) with the first point, before the response starts
+            first = next(data, None)
+        except (InfluxDBClientError, InfluxDBServerError, requests.exceptions.RequestException):
+            form.add_error(None, "Error occurred while querying the database")
+            return self.form_invalid(form)
+        # streamed as the points are read from InfluxDB
+        points = data if first is None else itertools.chain([first], data)
+        return StreamingHttpResponse(points, content_type='text/plain')
 
 def monitoring_system_spec(request, system_id):
     # Query the database for all necessary data for the form
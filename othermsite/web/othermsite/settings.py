@@ -12,13 +12,20 @@ https://docs.djangoproject.com/en/2.2/ref/settings/
 
 import os
 
+from celery.schedules import crontab
+
 LOGIN_REDIRECT_URL = '/'
 LOGOUT_REDIRECT_URL = '/'
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 
-CELERY_BROKER_URL = 'amqp://localhost'
+CELERY_BROKER_URL = os.environ.get("CELERY_BROKER_URL", default='amqp://localhost')
+# run tasks in-process instead of through the broker (local development and tests)
+CELERY_TASK_ALWAYS_EAGER = bool(int(os.environ.get("CELERY_TASK_ALWAYS_EAGER", default=0)))
+CELERY_TASK_EAGER_PROPAGATES = True
+# daily summaries cover UTC days
+CELERY_TIMEZONE = 'UTC'
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/2.2/howto/deployment/checklist/
@@ -99,12 +106,37 @@ TEMPLATES = [
 CELERY_IMPORTS = ['othermdbapp.tasks']
 
 CELERY_BEAT_SCHEDULE = {
- 'task-number-two': {
-        'task': 'othermdbapp.tasks.add',
-        'schedule': 10.0,
-    }
+    'nightly-daily-summaries': {
+        'task': 'othermdbapp.tasks.summarize_fleet',
+        'schedule': crontab(hour=1, minute=0),
+    },
+    # uploads queue this themselves, this picks up anything they could not queue
+    'resummarize-stale-days': {
+        'task': 'othermdbapp.tasks.resummarize_stale_days',
+        'schedule': crontab(minute=30),
+    },
 }
 
+# the InfluxDB server, and the connections each process keeps alive to it
+INFLUXDB_HOST = os.environ.get("INFLUXDB_HOST", default="influxdb")
+INFLUXDB_PORT = int(os.environ.get("INFLUXDB_PORT", default=8086))
+INFLUXDB_USER = os.environ.get("INFLUXDB_ADMIN_USER")
+INFLUXDB_PASSWORD = os.environ.get("INFLUXDB_ADMIN_PASSWORD")
+INFLUXDB_POOL_SIZE = int(os.environ.get("INFLUXDB_POOL_SIZE", default=10))
+
+# long InfluxDB reads are split into time slices of this many days, fetched by this many threads
+INFLUXDB_FETCH_SLICE_DAYS = int(os.environ.get("INFLUXDB_FETCH_SLICE_DAYS", default=31))
+INFLUXDB_FETCH_WORKERS = int(os.environ.get("INFLUXDB_FETCH_WORKERS", default=4))
+
+# points per chunk of the streamed (chunked) InfluxDB reads
+INFLUXDB_CHUNK_SIZE = int(os.environ.get("INFLUXDB_CHUNK_SIZE", default=10000))
+
+# first day summarized for equipment that has never been summarized
+DAILY_SUMMARY_START_DATE = os.environ.get("DAILY_SUMMARY_START_DATE", default='2016-01-01')
+
+# base temperatures (F) of the per-station degree days, besides the 65 F of the daily summaries
+DEGREE_DAY_BASE_TEMPERATURES_F = [float(base) for base in os.environ.get("DEGREE_DAY_BASE_TEMPERATURES_F", default="55,60,65").split(",")]
+
 WSGI_APPLICATION = 'othermsite.wsgi.application'
 
 # Database
@@ -159,3 +191,10 @@ STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, "static")
 
 IMPORT_EXPORT_USE_TRANSACTIONS = True
+
+# on-disk cache of raw equipment data (see othermdbapp/equipment_cache.py), disabled when not set
+EQUIPMENT_DATA_CACHE_DIR = os.environ.get("EQUIPMENT_DATA_CACHE_DIR")
+EQUIPMENT_DATA_CACHE_MAX_BYTES = int(os.environ.get("EQUIPMENT_DATA_CACHE_MAX_BYTES", default=10 * 2**30))
+# days are only cached once they are this many days over, since late points of recent days may still
+#   arrive in the "otherm" database by paths other than the upload view
+EQUIPMENT_DATA_CACHE_LATENCY_DAYS = int(os.environ.get("EQUIPMENT_DATA_CACHE_LATENCY_DAYS", default=3))